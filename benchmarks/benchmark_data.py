@@ -0,0 +1,229 @@
+"""
+    Times the slow paths of the GUI's data handling on synthetic sorting analyzers.
+
+    Builds a sorting analyzer of the requested size with spikeinterface's ground
+    truth generators, computes the extensions `load_sa_and_extensions` expects,
+    then times loading it into `DataForGUI`, `get_unit_data`, `merge_data`,
+    `compute_metrics`, `get_outlier_units` and getting similar units. Each step's
+    peak traced memory is recorded too (tracing slows things down a little, but
+    equally on every commit).
+
+    Run with e.g.
+        python benchmarks/benchmark_data.py --num-units 200 --duration 600
+    Results are written as json to benchmarks/results/<commit>.json. To compare
+    with an earlier run, pass `--compare benchmarks/results/<other commit>.json`.
+
+    Analyzers are kept in a temporary folder, keyed by their parameters, so they
+    are only generated once.
+"""
+import argparse
+import json
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+repo_folder = Path(__file__).parent.parent
+sys.path.insert(0, str(repo_folder / "gui_fast"))
+
+epoch_names = ["of1", "vr", "of2"]
+
+
+def get_analyzer_folder(args):
+
+    name = f"units{args.num_units}_channels{args.num_channels}_duration{args.duration:g}_rate{args.firing_rate:g}_seed{args.seed}"
+    return Path(args.analyzer_folder) / name
+
+
+def get_rec_samples(sorting_analyzer):
+    """Splits the recording into equal epochs, named like the real ones."""
+
+    num_samples = sorting_analyzer.get_num_samples(0)
+    edges = np.linspace(0, num_samples, len(epoch_names) + 1).astype(int)
+    return {epoch_name: int(edges[a + 1] - edges[a]) for a, epoch_name in enumerate(epoch_names)}
+
+
+def make_analyzer(folder, args):
+    """A sparse, binary folder sorting analyzer with every extension the GUI uses. Half the
+    units are silent in the first epoch, so there are outlier units to curate."""
+
+    import spikeinterface.full as si
+
+    recording, sorting = si.generate_ground_truth_recording(
+        durations=[args.duration], num_units=args.num_units, num_channels=args.num_channels,
+        sampling_frequency=30_000.0,
+        generate_sorting_kwargs={'firing_rates': args.firing_rate, 'refractory_period_ms': 4.0},
+        seed=args.seed)
+    # the GUI assumes unit ids are their indices
+    sorting = sorting.rename_units(np.arange(sorting.get_num_units()))
+
+    spike_vector = sorting.to_spike_vector()
+    first_epoch_samples = int(args.duration * 30_000 / len(epoch_names))
+    silent = (spike_vector['unit_index'] % 2 == 0) & (spike_vector['sample_index'] < first_epoch_samples)
+    sorting = si.NumpySorting(spike_vector[~silent], sampling_frequency=sorting.sampling_frequency,
+                              unit_ids=sorting.unit_ids)
+
+    sorting_analyzer = si.create_sorting_analyzer(
+        sorting, recording, format="binary_folder", folder=folder, overwrite=True, sparse=True)
+    sorting_analyzer.compute("random_spikes", max_spikes_per_unit=500)
+    sorting_analyzer.compute("waveforms", ms_before=1.0, ms_after=2.0)
+    sorting_analyzer.compute(["templates", "noise_levels", "spike_amplitudes", "spike_locations",
+                              "unit_locations", "correlograms", "template_similarity",
+                              "template_metrics", "quality_metrics"])
+
+
+def measure(results, name, function, num_calls=1):
+    """Runs `function` and records its time and peak traced memory under `name`."""
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    output = function()
+    seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results[name] = {
+        "seconds": seconds,
+        "num_calls": num_calls,
+        "ms_per_call": 1000 * seconds / num_calls,
+        "peak_memory_mb": peak_bytes / 1024**2,
+    }
+    print(f"{name:<32} {1000 * seconds / num_calls:10.2f} ms per call ({num_calls} calls), "
+          f"peak {peak_bytes / 1024**2:8.1f} MB")
+
+    return output
+
+
+def run_benchmarks(args):
+
+    from gui import load_sa_and_extensions
+    from wrangle import DataForGUI
+    from metrics import compute_metrics
+    from curate import get_outlier_units
+    # imported up front, so its import time (see check_import_time.py) isn't counted in the loading
+    import spikeinterface.full  # noqa: F401
+
+    analyzer_folder = get_analyzer_folder(args)
+    if not analyzer_folder.is_dir():
+        print(f"Making a sorting analyzer in {analyzer_folder}...")
+        make_analyzer(analyzer_folder, args)
+
+    results = {}
+
+    sorting_analyzer, have_extension = measure(
+        results, "load_sa_and_extensions", lambda: load_sa_and_extensions(analyzer_folder))
+    rec_samples = get_rec_samples(sorting_analyzer)
+
+    # without and with DataForGUI's on-disk cache
+    shutil.rmtree(analyzer_folder / "gui_cache", ignore_errors=True)
+    data = measure(results, "DataForGUI.__init__ (no cache)",
+                   lambda: DataForGUI(sorting_analyzer, have_extension, rec_samples))
+    data.executor.shutdown()
+    data = measure(results, "DataForGUI.__init__ (cached)",
+                   lambda: DataForGUI(sorting_analyzer, have_extension, rec_samples))
+
+    outlier_units = measure(results, "get_outlier_units", lambda: get_outlier_units(
+        data.spikes, rec_samples, sorting_analyzer.sampling_frequency))
+
+    unit_ids = list(data.unit_ids)
+    similar_units = measure(results, "get_similar_units",
+                            lambda: [data.neighbours.get_similar_units(unit_id) for unit_id in unit_ids],
+                            num_calls=len(unit_ids))
+
+    pairs = [(unit_id, similar[1]) for unit_id, similar in zip(unit_ids, similar_units) if len(similar) > 1]
+    pairs = pairs[:args.num_pairs]
+
+    measure(results, "get_unit_data", lambda: [data.get_unit_data(*pair) for pair in pairs],
+            num_calls=len(pairs))
+    measure(results, "compute_metrics", lambda: [compute_metrics(data, *pair) for pair in pairs],
+            num_calls=len(pairs))
+
+    # a chain of merges into the first outlier, as a curator would make them
+    merge_pairs = []
+    if len(outlier_units) > 0:
+        unit_id_1 = outlier_units[0]
+        merge_pairs = [(unit_id_1, unit_id_2)
+                       for unit_id_2 in data.neighbours.get_similar_units(unit_id_1)[1:args.num_merges + 1]]
+
+    measure(results, "merge_data", lambda: [data.merge_data(*pair) for pair in merge_pairs],
+            num_calls=max(1, len(merge_pairs)))
+    measure(results, "merged get_unit_data", lambda: [data.get_unit_data(*pair) for pair in merge_pairs],
+            num_calls=max(1, len(merge_pairs)))
+    measure(results, "undo_merge", lambda: [data.undo_merge() for _ in merge_pairs],
+            num_calls=max(1, len(merge_pairs)))
+
+    data.executor.shutdown()
+
+    return results
+
+
+def get_commit():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_folder,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, other_path):
+
+    with open(other_path) as other_file:
+        other = json.load(other_file)
+
+    print(f"\nCompared with {other_path} (commit {other['commit']}):")
+    for name, result in results.items():
+        if name in other["results"]:
+            ratio = result["ms_per_call"] / max(other["results"][name]["ms_per_call"], 1e-9)
+            print(f"{name:<32} {ratio:6.2f}x time")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-units", type=int, default=100)
+    parser.add_argument("--num-channels", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=300.0, help="in seconds")
+    parser.add_argument("--firing-rate", type=float, default=10.0, help="in Hz")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num-pairs", type=int, default=50)
+    parser.add_argument("--num-merges", type=int, default=5)
+    parser.add_argument("--analyzer-folder", default=Path(tempfile.gettempdir()) / "gui_fast_benchmarks")
+    parser.add_argument("--output", default=None, help="defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", default=None, help="an earlier results file to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+
+    import spikeinterface
+    commit = get_commit()
+    output = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "versions": {"python": platform.python_version(), "numpy": np.__version__,
+                     "spikeinterface": spikeinterface.__version__},
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "results": results,
+    }
+
+    output_path = Path(args.output) if args.output else Path(__file__).parent / "results" / f"{commit}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(output, output_file, indent=4)
+    print(f"\nResults written to {output_path}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
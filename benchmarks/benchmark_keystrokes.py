@@ -0,0 +1,199 @@
+"""
+    Times how long the GUI takes from a key press to a finished repaint.
+
+    Runs `MainWindow` with Qt's offscreen platform, so it works without a display,
+    on a synthetic sorting analyzer made like in benchmark_data.py. A scripted
+    sequence of keys is sent to `keyPressEvent`, a key every `--key-interval-ms`
+    like a curator would press them, and after each one the window is repainted.
+
+    Each key press's time is split into
+        fetch:                 getting the pair's data from the prefetcher, including waiting for it
+        get_unit_data:         the part of fetch spent computing the unit data on the GUI thread
+        metrics:               the part of fetch spent computing the metrics on the GUI thread
+        update_plot:           updating the plots, apart from the templates
+        update_template_plot:  updating the all-templates plot
+        repaint:               painting the window
+    and the percentiles of each are printed per key.
+
+    Run with e.g.
+        python benchmarks/benchmark_keystrokes.py --num-units 200 --keys sssasskm --repeats 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from benchmark_data import get_analyzer_folder, get_rec_samples, make_analyzer, get_commit
+
+stage_names = ["total", "fetch", "get_unit_data", "metrics", "update_plot", "update_template_plot", "repaint"]
+percentiles = [50, 90, 99, 100]
+
+
+class StageTimer:
+    """Adds up the time spent in the wrapped methods, on the GUI thread only, for the current key press."""
+
+    def __init__(self):
+
+        self.current = defaultdict(float)
+
+    def wrap(self, instance, method_name, stage_name):
+
+        method = getattr(instance, method_name)
+
+        def timed_method(*args, **kwargs):
+            if threading.current_thread() is not threading.main_thread():
+                return method(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.current[stage_name] += time.perf_counter() - start
+
+        setattr(instance, method_name, timed_method)
+
+    def pop(self):
+
+        times, self.current = self.current, defaultdict(float)
+        return times
+
+
+def make_window(args, save_folder):
+
+    from PyQt6 import QtWidgets
+    from gui import MainWindow, load_sa_and_extensions
+
+    analyzer_folder = get_analyzer_folder(args)
+    if not analyzer_folder.is_dir():
+        print(f"Making a sorting analyzer in {analyzer_folder}...")
+        make_analyzer(analyzer_folder, args)
+
+    sorting_analyzer, have_extension = load_sa_and_extensions(analyzer_folder)
+    rec_samples = get_rec_samples(sorting_analyzer)
+
+    window = MainWindow(sorting_analyzer, have_extension, rec_samples, save_folder)
+    window.resize(1600, 800)
+    window.show()
+    window.wait_until_loaded()
+    QtWidgets.QApplication.processEvents()
+
+    return window
+
+
+def press_keys(window, keys, key_interval_s):
+    """Sends each key to the window and returns the stage times of each key press."""
+
+    from PyQt6 import QtCore, QtGui, QtWidgets
+
+    stage_timer = StageTimer()
+    stage_timer.wrap(window.prefetcher, "get", "fetch")
+    stage_timer.wrap(window.data, "get_unit_data", "get_unit_data")
+    stage_timer.wrap(window.data, "get_pair_metrics", "metrics")
+    stage_timer.wrap(window, "update_plot", "update_plot")
+    stage_timer.wrap(window, "update_template_plot", "update_template_plot")
+
+    key_times = []
+    for key in keys:
+        event = QtGui.QKeyEvent(QtCore.QEvent.Type.KeyPress, QtCore.Qt.Key.Key_unknown,
+                                QtCore.Qt.KeyboardModifier.NoModifier, key)
+        stage_timer.pop()
+
+        start = time.perf_counter()
+        try:
+            window.keyPressEvent(event)
+            # key presses only schedule the drawing, for when the queued events are handled
+            window.flush_render()
+        except IndexError:
+            print(f"Ran out of units to look at after {len(key_times)} keys.")
+            break
+        repaint_start = time.perf_counter()
+        window.repaint()
+        end = time.perf_counter()
+
+        times = stage_timer.pop()
+        times["repaint"] = end - repaint_start
+        times["total"] = end - start
+        # update_plot's time doesn't include the template plot's
+        times["update_plot"] -= times["update_template_plot"]
+        key_times.append((key, times))
+
+        # the time between key presses, when the prefetcher gets ahead
+        next_key_time = end + key_interval_s
+        while time.perf_counter() < next_key_time:
+            QtWidgets.QApplication.processEvents()
+            time.sleep(0.001)
+
+    return key_times
+
+
+def summarise(key_times):
+    """Percentiles, in ms, of each stage's time for each key, and for all keys together."""
+
+    summary = {}
+    for key in sorted(set(key for key, _ in key_times)) + ["all"]:
+        chosen_times = [times for times_key, times in key_times if key in ["all", times_key]]
+        summary[key] = {"num_presses": len(chosen_times)}
+        for stage_name in stage_names:
+            stage_times_ms = 1000 * np.array([times[stage_name] for times in chosen_times])
+            summary[key][stage_name] = {f"p{percentile}": float(np.percentile(stage_times_ms, percentile))
+                                        for percentile in percentiles}
+
+    return summary
+
+
+def print_summary(summary):
+
+    for key, key_summary in summary.items():
+        print(f"\nKey '{key}', {key_summary['num_presses']} presses (ms)")
+        print(f"{'':<22}" + "".join(f"{f'p{percentile}':>10}" for percentile in percentiles))
+        for stage_name in stage_names:
+            print(f"{stage_name:<22}" + "".join(
+                f"{key_summary[stage_name][f'p{percentile}']:10.2f}" for percentile in percentiles))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-units", type=int, default=100)
+    parser.add_argument("--num-channels", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=300.0, help="in seconds")
+    parser.add_argument("--firing-rate", type=float, default=10.0, help="in Hz")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--analyzer-folder", default=Path(tempfile.gettempdir()) / "gui_fast_benchmarks")
+    parser.add_argument("--keys", default="sssasssaskjsssmsss", help="the keys pressed, in order")
+    parser.add_argument("--repeats", type=int, default=5, help="how many times the keys are pressed")
+    parser.add_argument("--key-interval-ms", type=float, default=200.0)
+    parser.add_argument("--output", default=None, help="a json file to write the percentiles to")
+    args = parser.parse_args()
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6 import QtWidgets
+
+    app = QtWidgets.QApplication(sys.argv)
+
+    # a new save folder, so there's no journal to replay
+    with tempfile.TemporaryDirectory() as save_folder:
+        window = make_window(args, Path(save_folder))
+        key_times = press_keys(window, args.keys * args.repeats, args.key_interval_ms / 1000)
+        window.close()
+
+    summary = summarise(key_times)
+    print_summary(summary)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"commit": get_commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "params": {key: str(value) if isinstance(value, Path) else value
+                                  for key, value in vars(args).items()},
+                       "qt_platform": app.platformName(), "summary": summary}, output_file, indent=4)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
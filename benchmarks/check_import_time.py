@@ -0,0 +1,56 @@
+"""
+    Checks that importing the GUI stays fast, and that it doesn't pull in the
+    slow-to-import packages (spikeinterface, sklearn, pandas, pyqtgraph's
+    widgets) before they are needed.
+
+    Run with `python benchmarks/check_import_time.py`. Exits with an error if
+    the budget is blown.
+"""
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+gui_folder = Path(__file__).parent.parent / "gui_fast"
+
+import_time_budget_s = 0.5
+number_of_runs = 5
+
+deferred_modules = ["spikeinterface", "sklearn", "pandas", "pyqtgraph.graphicsItems"]
+
+time_import = f"""
+import json, sys, time
+start = time.perf_counter()
+import gui
+import_time = time.perf_counter() - start
+print(json.dumps({{"import_time": import_time, "loaded": [m for m in {deferred_modules!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import():
+    output = subprocess.run([sys.executable, "-c", time_import], cwd=gui_folder,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+
+    results = [measure_import() for _ in range(number_of_runs)]
+    import_time = min(result["import_time"] for result in results)
+    loaded = results[0]["loaded"]
+
+    print(f"import gui: {import_time*1000:.0f} ms (budget {import_time_budget_s*1000:.0f} ms)")
+
+    failed = False
+    if import_time > import_time_budget_s:
+        print("    - Over the import time budget!")
+        failed = True
+    for module in loaded:
+        print(f"    - {module} is imported by `import gui`, but should only be imported when needed.")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
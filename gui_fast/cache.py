@@ -0,0 +1,70 @@
+"""
+    Small in-memory caches for data which is expensive to compute for a pair of units
+"""
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+def get_nbytes(value):
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(get_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_nbytes(item) for item in value)
+    return 0
+
+
+class PairCache:
+    """Least-recently-used cache, keyed on tuples which start with a pair of unit ids.
+    Limited by both the number of entries and their total size in bytes."""
+
+    def __init__(self, max_items=128, max_bytes=512 * 1024**2):
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+
+    def get(self, key):
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+
+        nbytes = get_nbytes(value)
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while len(self.entries) > self.max_items or self.nbytes > self.max_bytes:
+                _, (_, old_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+    def evict_units(self, unit_ids):
+        """Removes every entry involving any of `unit_ids`."""
+
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if key[0] in unit_ids or key[1] in unit_ids:
+                    self.nbytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
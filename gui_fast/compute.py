@@ -1,44 +1,101 @@
 import numpy as np
 from numpy.linalg import norm
 
-from sklearn.decomposition import IncrementalPCA, PCA
-import spikeinterface.full as si
 
+def get_binned_counts(all_spikes, unit_ids, num_bins, total_samples):
+    """Spike counts of each of `unit_ids` in `num_bins` equal bins from 0 to `total_samples`.
+    Spikes after `total_samples` are counted in the last bin."""
 
-def get_binned_spikes(spikes_1, spikes_2):
+    edges = np.linspace(0, total_samples, num_bins + 1)
 
-    binned_spikes_1, _ = np.histogram(spikes_1, bins=20)
-    binned_spikes_2, _ = np.histogram(spikes_2, bins=20)
+    # each unit's counts are only computed once, however many pairs it is in
+    unit_counts = {}
+    for unit_id in set(unit_ids):
+        cumulative_counts = np.searchsorted(all_spikes[unit_id], edges, side='left')
+        cumulative_counts[-1] = len(all_spikes[unit_id])
+        unit_counts[unit_id] = np.diff(cumulative_counts)
+
+    return np.array([unit_counts[unit_id] for unit_id in unit_ids]).reshape(-1, num_bins)
+
+
+def get_binned_spikes(all_spikes, unit_id_1, unit_id_2, total_samples, num_bins=20):
+
+    binned_spikes_1, binned_spikes_2 = get_binned_counts(
+        all_spikes, [unit_id_1, unit_id_2], num_bins, total_samples)
 
     return binned_spikes_1, binned_spikes_2
 
 
-def get_concat_waveforms(waveforms, unit_id_1, unit_id_2, unit_id_to_channel_indices, n_components=2, whiten=False):
+def get_correlogram_bins(sampling_frequency, window_ms=50.0, bin_ms=1.0):
+    """The half-window and bin size, in samples, which spikeinterface's correlograms use."""
+
+    window_size = int(round(sampling_frequency * window_ms / 2 * 1e-3))
+    bin_size = int(round(sampling_frequency * bin_ms * 1e-3))
+    window_size -= window_size % bin_size
+
+    return window_size, bin_size
+
+
+def get_correlogram(spikes_1, spikes_2, window_size, bin_size, same_unit=False, chunk_size=10_000):
+    """Cross-correlogram of two sorted spike trains, matching spikeinterface's: counts of
+    the lags `spike_1 - spike_2` in [-window_size, window_size), binned by `bin_size`.
+
+    Uses searchsorted to find the spikes of unit 2 within the window of each spike of
+    unit 1, so only lags inside the window are made. If `same_unit`, the two trains are the
+    same and a spike isn't compared to itself."""
+
+    num_half_bins = window_size // bin_size
+    correlogram = np.zeros(2 * num_half_bins, dtype='int64')
+
+    for start in range(0, len(spikes_1), chunk_size):
+        chunk = spikes_1[start:start + chunk_size]
+
+        first_index = np.searchsorted(spikes_2, chunk - window_size, side='right')
+        last_index = np.searchsorted(spikes_2, chunk + window_size, side='right')
+        num_lags = last_index - first_index
+
+        spike_1_index = np.repeat(np.arange(len(chunk)), num_lags)
+        lag_offsets = np.arange(len(spike_1_index)) - np.repeat(np.cumsum(num_lags) - num_lags, num_lags)
+        spike_2_index = first_index[spike_1_index] + lag_offsets
+
+        if same_unit:
+            not_itself = spike_2_index != spike_1_index + start
+            spike_1_index = spike_1_index[not_itself]
+            spike_2_index = spike_2_index[not_itself]
+
+        lags = chunk[spike_1_index].astype('int64') - spikes_2[spike_2_index].astype('int64')
+        correlogram += np.bincount(lags // bin_size + num_half_bins, minlength=2 * num_half_bins)
+
+    return correlogram
+
+
+def get_common_channels(unit_id_to_channel_indices, unit_id_1, unit_id_2):
 
     unit_1_channels = unit_id_to_channel_indices[unit_id_1]
     unit_2_channels = unit_id_to_channel_indices[unit_id_2]
 
-    common_ids = np.intersect1d(unit_1_channels, unit_2_channels)
+    return np.intersect1d(unit_1_channels, unit_2_channels)
+
+
+def get_concat_waveforms(waveform_reader, unit_id_1, unit_id_2, unit_id_to_channel_indices, n_components=2, whiten=False):
+
+    common_ids = get_common_channels(unit_id_to_channel_indices, unit_id_1, unit_id_2)
     if len(common_ids) == 0:
         return None
 
-    waveforms_1 = waveforms.get_waveforms_one_unit(
-        unit_id=unit_id_1, force_dense=True)[:, :, common_ids]
-    waveforms_2 = waveforms.get_waveforms_one_unit(
-        unit_id=unit_id_2, force_dense=True)[:, :, common_ids]
-
-    num_waveforms = min(np.shape(waveforms_1)[0], np.shape(waveforms_2)[0])
+    num_waveforms = min(waveform_reader.get_num_waveforms(unit_id_1), waveform_reader.get_num_waveforms(unit_id_2))
 
-    waveforms_1_concat = np.array(
-        [np.concatenate(waveforms_1[a, :, :]) for a in range(num_waveforms)])
-    waveforms_2_concat = np.array(
-        [np.concatenate(waveforms_2[a, :, :]) for a in range(num_waveforms)])
+    waveforms_1_concat = waveform_reader.get_flat_waveforms(unit_id_1, common_ids, num_waveforms)
+    waveforms_2_concat = waveform_reader.get_flat_waveforms(unit_id_2, common_ids, num_waveforms)
 
     return waveforms_1_concat, waveforms_2_concat
 
 
 def get_pcs_from_waveforms(waveforms_1, waveforms_2, n_components=4, whiten=True):
 
+    # sklearn is slow to import, so only do it when we first need it
+    from sklearn.decomposition import IncrementalPCA
+
     pca_model = IncrementalPCA(n_components=n_components, whiten=whiten)
 
     waveforms = np.concatenate([waveforms_1, waveforms_2])
@@ -49,3 +106,103 @@ def get_pcs_from_waveforms(waveforms_1, waveforms_2, n_components=4, whiten=True
     pcas_2 = pca_model.transform(waveforms_2)
 
     return pcas_1, pcas_2
+
+
+def get_shared_projections(sorting_analyzer, waveform_reader, unit_id_to_channel_indices, n_components=3, max_snippets=50_000, seed=0):
+    """Projects every unit's waveforms, on each of its `unit_id_to_channel_indices` channels,
+    onto one shared temporal basis. Returns a dict of unit_id -> (projections, channel_indices)
+    with projections of shape (num_waveforms, n_components, num_channels).
+
+    Uses the analyzer's principal_components extension if it exists. Otherwise the basis is
+    found with one SVD of waveform snippets sampled from all units."""
+
+    unit_ids = sorting_analyzer.unit_ids
+
+    pc_extension = sorting_analyzer.get_extension("principal_components")
+    if pc_extension is not None and pc_extension.params["mode"] != "concatenated":
+        shared_projections = {}
+        for unit_id in unit_ids:
+            if sorting_analyzer.sparsity is None:
+                projections = pc_extension.get_projections_one_unit(unit_id)
+                channel_indices = np.arange(projections.shape[2])
+            else:
+                projections, channel_indices = pc_extension.get_projections_one_unit(unit_id, sparse=True)
+            shared_projections[unit_id] = restrict_to_channels(
+                projections, channel_indices, unit_id_to_channel_indices[unit_id])
+        return shared_projections
+
+    def get_unit_waveforms(unit_id):
+        channel_indices = np.intersect1d(
+            waveform_reader.get_channel_indices(unit_id), unit_id_to_channel_indices[unit_id])
+        return waveform_reader.get_waveforms(unit_id, channel_indices), channel_indices
+
+    rng = np.random.default_rng(seed)
+    snippets_per_unit = max(1, max_snippets // max(1, len(unit_ids)))
+    snippets = []
+    for unit_id in unit_ids:
+        waveforms, _ = get_unit_waveforms(unit_id)
+        unit_snippets = np.moveaxis(waveforms, 2, 1).reshape(-1, waveforms.shape[1])
+        if len(unit_snippets) > snippets_per_unit:
+            unit_snippets = unit_snippets[rng.choice(len(unit_snippets), size=snippets_per_unit, replace=False)]
+        snippets.append(unit_snippets)
+    snippets = np.concatenate(snippets)
+
+    mean_snippet = np.mean(snippets, axis=0)
+    _, _, components = np.linalg.svd(snippets - mean_snippet, full_matrices=False)
+    components = components[:n_components]
+
+    shared_projections = {}
+    for unit_id in unit_ids:
+        waveforms, channel_indices = get_unit_waveforms(unit_id)
+        projections = np.einsum("ntc,kt->nkc", waveforms - mean_snippet[:, np.newaxis], components)
+        shared_projections[unit_id] = (projections.astype(np.float32), channel_indices)
+
+    return shared_projections
+
+
+def restrict_to_channels(data, channel_indices, keep_channel_indices):
+    """Keeps the last axis of `data` for the channels in `keep_channel_indices`."""
+
+    keep = np.isin(channel_indices, keep_channel_indices)
+    return data[:, :, keep], np.asarray(channel_indices)[keep]
+
+
+def get_channel_positions(channel_indices, common_ids):
+
+    sorter = np.argsort(channel_indices)
+    return sorter[np.searchsorted(channel_indices, common_ids, sorter=sorter)]
+
+
+def get_pcs_from_projections(projections_1, channels_1, projections_2, channels_2, n_components=4):
+    """Principal components of a pair from their shared projections on the common channels.
+    Only a small SVD, over n_components x num_common_channels features, is needed."""
+
+    common_ids = np.intersect1d(channels_1, channels_2)
+    if len(common_ids) == 0:
+        return None
+
+    num_waveforms = min(np.shape(projections_1)[0], np.shape(projections_2)[0])
+
+    features_1 = projections_1[:num_waveforms, :, get_channel_positions(
+        channels_1, common_ids)].reshape(num_waveforms, -1)
+    features_2 = projections_2[:num_waveforms, :, get_channel_positions(
+        channels_2, common_ids)].reshape(num_waveforms, -1)
+
+    features = np.concatenate([features_1, features_2])
+    mean_features = np.mean(features, axis=0)
+    _, singular_values, components = np.linalg.svd(
+        features - mean_features, full_matrices=False)
+
+    # whiten, as in get_pcs_from_waveforms
+    scale = np.sqrt(len(features) - 1) / np.maximum(singular_values[:n_components], 1e-12)
+    components = components[:n_components] * scale[:, np.newaxis]
+
+    pcas_1 = (features_1 - mean_features) @ components.T
+    pcas_2 = (features_2 - mean_features) @ components.T
+
+    if pcas_1.shape[1] < n_components:
+        padding = ((0, 0), (0, n_components - pcas_1.shape[1]))
+        pcas_1 = np.pad(pcas_1, padding)
+        pcas_2 = np.pad(pcas_2, padding)
+
+    return pcas_1, pcas_2
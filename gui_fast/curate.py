@@ -16,35 +16,45 @@ def get_good_units(analyzer):
     return good_qms
 
 
-def get_type_of_firing(spike, rec_samples, threshold=0.3):
+def get_epoch_edges(rec_samples):
+    """The sample each epoch starts at, and the end of the last one. Epochs are in the order of `rec_samples`."""
 
-    num_of1spikes = np.sum(
-        spike < rec_samples['of1'])/rec_samples['of1']*30_000
-    num_vrspikes = np.sum((rec_samples['of1']+rec_samples['vr'] > spike) & (
-        spike > rec_samples['of1']))/rec_samples['vr']*30_000
-    num_of2spikes = np.sum(
-        spike > rec_samples['of1']+rec_samples['vr'])/rec_samples['of2']*30_000
+    return np.concatenate([[0], np.cumsum(list(rec_samples.values()))])
 
-    all_frs = [num_of1spikes, num_vrspikes, num_of2spikes]
 
-    which_is_max = np.argmax(all_frs)
-    other_ones = set([0, 1, 2]).difference({which_is_max})
+def get_epoch_firing_rates(all_spikes, rec_samples, sampling_frequency=30_000):
+    """Firing rate, in Hz, of every unit in each epoch. Returns an array of shape
+    (num_units, num_epochs), in the order of `all_spikes.keys()`."""
 
-    active = [1, 1, 1]
-    for other_one in other_ones:
-        if all_frs[other_one] < all_frs[which_is_max]*threshold:
-            active[other_one] = 0
+    edges = get_epoch_edges(rec_samples)
+    durations_s = np.diff(edges) / sampling_frequency
 
-    return active
+    # each unit's spikes are sorted, so its cumulative spike count at each edge is one searchsorted
+    cumulative_counts = np.zeros((len(all_spikes), len(edges)), dtype='int64')
+    for unit_index, unit_id in enumerate(all_spikes.keys()):
+        cumulative_counts[unit_index] = np.searchsorted(all_spikes[unit_id], edges, side='left')
 
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.diff(cumulative_counts, axis=1) / durations_s
 
-def get_outlier_units(all_spikes, samples):
 
-    outliers = []
+def get_active_epochs(firing_rates, threshold=0.3):
+    """Whether each unit is active in each epoch: if its rate is at least `threshold` times its highest rate."""
 
-    for unit_id, spike_train in all_spikes.items():
-        type_of_firing = get_type_of_firing(spike_train, samples)
-        if type_of_firing != [1, 1, 1]:
-            outliers.append(unit_id)
+    max_rates = np.max(firing_rates, axis=1, keepdims=True)
+    return firing_rates >= max_rates * threshold
 
-    return outliers
+
+def get_type_of_firing(spike, rec_samples, threshold=0.3, sampling_frequency=30_000):
+
+    firing_rates = get_epoch_firing_rates({0: spike}, rec_samples, sampling_frequency)
+    return [int(active) for active in get_active_epochs(firing_rates, threshold)[0]]
+
+
+def get_outlier_units(all_spikes, samples, sampling_frequency=30_000, threshold=0.3):
+    """Units which are inactive in at least one epoch."""
+
+    firing_rates = get_epoch_firing_rates(all_spikes, samples, sampling_frequency)
+    is_outlier = ~np.all(get_active_epochs(firing_rates, threshold), axis=1)
+
+    return [unit_id for unit_id, outlier in zip(all_spikes.keys(), is_outlier) if outlier]
@@ -0,0 +1,94 @@
+"""
+    Saving the arrays which DataForGUI derives from the sorting analyzer to disk,
+    so that relaunching the GUI on the same analyzer can skip recomputing them.
+
+    Each cache lives in its own folder, named by a hash of the analyzer path, the
+    modification times of its files and extensions, and the parameters used.
+    If any of these change, a new cache is made, and the old ones are deleted
+    once it's written.
+"""
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+CACHE_VERSION = 3
+CACHE_FOLDER_NAME = "gui_cache"
+
+# folders we write into the analyzer folder ourselves, so shouldn't invalidate the cache
+ignored_analyzer_paths = ["merge_info", CACHE_FOLDER_NAME]
+
+
+def get_analyzer_mtimes(analyzer_path):
+    """Modification times of the analyzer's top-level files and of each extension."""
+
+    analyzer_path = Path(analyzer_path)
+    mtimes = {}
+
+    for path in sorted(analyzer_path.iterdir()):
+        if path.name not in ignored_analyzer_paths:
+            mtimes[path.name] = path.stat().st_mtime_ns
+
+    extensions_path = analyzer_path / "extensions"
+    if extensions_path.is_dir():
+        for extension_path in sorted(extensions_path.iterdir()):
+            paths = [extension_path]
+            if extension_path.is_dir():
+                paths += list(extension_path.iterdir())
+            mtimes[f"extensions/{extension_path.name}"] = max(path.stat().st_mtime_ns for path in paths)
+
+    return mtimes
+
+
+def get_cache_folder(cache_root, analyzer_path, params):
+    """The folder holding the cache for this analyzer and these parameters."""
+
+    analyzer_path = Path(analyzer_path).resolve()
+    key = {
+        "version": CACHE_VERSION,
+        "analyzer_path": str(analyzer_path),
+        "mtimes": get_analyzer_mtimes(analyzer_path),
+        "params": params,
+    }
+    key_hash = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    return Path(cache_root) / f"v{CACHE_VERSION}_{key_hash}"
+
+
+def save_arrays(cache_folder, arrays):
+    """Saves a dict of arrays as .npy files. The folder only appears once everything is written."""
+
+    cache_folder = Path(cache_folder)
+    tmp_folder = cache_folder.with_name(cache_folder.name + ".tmp")
+    if tmp_folder.exists():
+        shutil.rmtree(tmp_folder)
+    tmp_folder.mkdir(parents=True)
+
+    for name, array in arrays.items():
+        np.save(tmp_folder / f"{name}.npy", np.asarray(array))
+
+    if cache_folder.exists():
+        shutil.rmtree(cache_folder)
+    tmp_folder.rename(cache_folder)
+
+
+def remove_stale_caches(cache_folder):
+    """Deletes the caches next to `cache_folder`, which were made for other versions,
+    analyzer files or parameters, so they don't pile up in the analyzer folder."""
+
+    cache_folder = Path(cache_folder)
+    for path in cache_folder.parent.glob("v*_*"):
+        if path.is_dir() and path.name != cache_folder.name:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_arrays(cache_folder, mmap_mode="r"):
+    """Loads a cache as a dict of memory-mapped arrays. Returns None if there is no cache."""
+
+    cache_folder = Path(cache_folder)
+    if not cache_folder.is_dir():
+        return None
+
+    return {path.stem: np.load(path, mmap_mode=mmap_mode) for path in cache_folder.glob("*.npy")}
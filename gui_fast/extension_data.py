@@ -0,0 +1,41 @@
+"""
+    Reading arrays from the analyzer's extensions without loading them whole.
+
+    For analyzers saved as a binary folder, extension arrays are memory-mapped
+    straight from their .npy files, so only the parts which are read come off disk.
+"""
+from pathlib import Path
+
+import numpy as np
+
+
+def load_extension_array(sorting_analyzer, extension_name, array_name):
+    """One of an extension's arrays, memory-mapped if the analyzer's format allows.
+    Otherwise the extension is loaded as usual."""
+
+    if sorting_analyzer.format == "binary_folder":
+        array_path = Path(sorting_analyzer.folder) / "extensions" / extension_name / f"{array_name}.npy"
+        if array_path.is_file():
+            return np.load(array_path, mmap_mode="r")
+
+    return sorting_analyzer.get_extension(extension_name).data[array_name]
+
+
+def gather(array, indices, chunk_size=1_000_000):
+    """Same as `array[indices]`. The indices are read in sorted order, a chunk at a time, so a
+    memory-mapped array is read front to back and only the pages holding the indices are touched."""
+
+    indices = np.asarray(indices)
+    order = np.argsort(indices, kind="stable")
+    sorted_indices = indices[order]
+
+    gathered = np.empty((len(indices),) + array.shape[1:], dtype=array.dtype)
+    for start in range(0, len(indices), chunk_size):
+        chunk_indices = sorted_indices[start:start + chunk_size]
+        if isinstance(array, np.ndarray):
+            gathered[order[start:start + chunk_size]] = array[chunk_indices]
+        else:
+            # e.g. zarr
+            gathered[order[start:start + chunk_size]] = array.oindex[chunk_indices]
+
+    return gathered
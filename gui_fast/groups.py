@@ -0,0 +1,53 @@
+"""
+    Which units have been merged together.
+
+    Each group of merged units is named by its root: the unit which the others
+    were merged into. Merges can be undone, most recent first, by `split`.
+"""
+
+
+class MergeGroups:
+
+    def __init__(self, unit_ids):
+
+        self.root_of = {unit_id: unit_id for unit_id in unit_ids}
+        self.members_of = {unit_id: [unit_id] for unit_id in unit_ids}
+        # the members each merged-away root had when it was merged, so the merge can be undone
+        self.absorbed = {}
+
+    def find(self, unit_id):
+        """The root of the group `unit_id` is in."""
+
+        return self.root_of[unit_id]
+
+    def is_root(self, unit_id):
+        """Whether `unit_id` still names a group, i.e. hasn't been merged into another unit."""
+
+        return self.find(unit_id) == unit_id
+
+    def members(self, unit_id):
+        """All the units in the group `unit_id` is the root of."""
+
+        return self.members_of[unit_id]
+
+    def merge(self, root_1, root_2):
+        """Merges the group of `root_2` into the group of `root_1`. The merged group has to keep
+        `root_1` as its root, since that's where its data is, so group 2 is always the one
+        relabelled, at a cost of O(size of group 2)."""
+
+        members_2 = self.members_of.pop(root_2)
+        for unit_id in members_2:
+            self.root_of[unit_id] = root_1
+
+        self.members_of[root_1] = self.members_of[root_1] + members_2
+        self.absorbed[root_2] = members_2
+
+    def split(self, root_1, root_2):
+        """Undoes `merge(root_1, root_2)`. Only valid if every later merge into `root_1` has been undone."""
+
+        members_2 = self.absorbed.pop(root_2)
+        for unit_id in members_2:
+            self.root_of[unit_id] = root_2
+
+        self.members_of[root_1] = self.members_of[root_1][:-len(members_2)]
+        self.members_of[root_2] = members_2
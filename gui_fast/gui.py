@@ -2,21 +2,25 @@
     Controls the visualisation. All the GUI stuff!
 """
 
-import pandas as pd
 import sys
 from pathlib import Path
+import time
 import PyQt6.QtWidgets as QtWidgets
+from PyQt6 import QtCore
 import numpy as np
-import pyqtgraph as pg
-import spikeinterface.full as si
+
+from lazy import lazy_import
 
 
-from similarity import get_similar_units
 from wrangle import DataForGUI
+from journal import DecisionJournal
 from curate import get_good_units, get_outlier_units
-from metrics import compute_metrics, qm_metrics_list, tm_metrics_list
+from metrics import qm_metrics_list, tm_metrics_list
+from prefetch import PairPrefetcher
+from timing import timer
 
-pg.setConfigOption('background', 'w')
+# these are slow to import, so are only imported when first used
+pg = lazy_import("pyqtgraph")
 
 
 
@@ -42,26 +46,49 @@ mouse_days = {
 def load_sa_and_extensions(analyzer_path):
     """Loads the sorting analyzer and it's extensions"""
 
+    import spikeinterface.full as si
+
     print("\nLoading sorting analyzer...")
     have_extension = {}
     sorting_analyzer = si.load_sorting_analyzer(analyzer_path, load_extensions=False)
     missing_an_extension = False
-    for extension in ['correlograms', 'unit_locations', 'templates', 'spike_amplitudes', 'spike_locations', 'quality_metrics', 'template_metrics']:
-        have_extension[extension] = True
-        try:
-            sorting_analyzer.load_extension(extension)
-        except:
+    # per-spike extensions are big, and only a subsample of them is read later, so aren't loaded here
+    per_spike_extensions = ['spike_amplitudes', 'spike_locations']
+    for extension in ['unit_locations', 'templates', 'spike_amplitudes', 'spike_locations', 'quality_metrics', 'template_metrics']:
+        have_extension[extension] = sorting_analyzer.has_extension(extension)
+        problem = f"No {extension} found"
+        if have_extension[extension] and extension not in per_spike_extensions:
+            try:
+                # an extension whose data was never saved loads as None
+                have_extension[extension] = sorting_analyzer.load_extension(extension) is not None
+            except (OSError, ValueError, KeyError) as error:
+                have_extension[extension] = False
+                problem = f"Could not load {extension} ({error!r})"
+        if not have_extension[extension]:
             if missing_an_extension is False:
                 print("")
             missing_an_extension = True
-            have_extension[extension] = False
-            print(f"    - No {extension} found. Will not display certain plots.")
+            print(f"    - {problem}. Will not display certain plots.")
     if missing_an_extension:
         print("")
 
     return sorting_analyzer, have_extension
 
 
+def show_loading_label(text):
+    """A placeholder window, shown while the data for the real one is loaded."""
+
+    loading_label = QtWidgets.QLabel(text)
+    loading_label.setWindowTitle("QuickCurate")
+    loading_label.setMargin(40)
+    loading_label.resize(1600, 800)
+    loading_label.show()
+    loading_label.repaint()
+    QtWidgets.QApplication.processEvents()
+
+    return loading_label
+
+
 def main():
 
     mouse = 22
@@ -71,16 +98,21 @@ def main():
     save_folder = analyzer_path / "merge_info/"
     save_folder.mkdir(exist_ok=True)
 
+    app = QtWidgets.QApplication(sys.argv)
+
+    loading_label = show_loading_label("Loading sorting analyzer...")
+
     sorting_analyzer, have_extension = load_sa_and_extensions(analyzer_path)
 
     #sorting_analyzer.compute({"template_metrics": {"include_multi_channel_metrics": True}})
-    app = QtWidgets.QApplication(sys.argv)
 
+    import pandas as pd
     rec_samples = pd.read_csv("/run/user/1000/gvfs/smb-share:server=cmvm.datastore.ed.ac.uk,share=cmvm/sbms/groups/CDBS_SIDB_storage/NolanLab/ActiveProjects/Chris/Cohort12/derivatives/labels/all_rec_samples_of_vr_of.csv")
     me_rec = rec_samples.query(f"mouse == {mouse} & day == {day}")[['of1', 'vr', 'of2']]
     rec_samples = dict(zip(list(me_rec.keys()), list(me_rec.values[0])))
 
     window = MainWindow(sorting_analyzer, have_extension, rec_samples, save_folder)
+    loading_label.close()
 
     window.resize(1600, 800)
     window.show()
@@ -88,37 +120,29 @@ def main():
     sys.exit(app.exec())
 
 
+class LoadingProgress(QtCore.QObject):
+    """Passes news of finished loading tasks from DataForGUI's worker threads to the GUI thread."""
+    task_loaded = QtCore.pyqtSignal(str)
+
+
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, sorting_analyzer, have_extension, rec_samples, save_folder):
+    def __init__(self, sorting_analyzer, have_extension, rec_samples, save_folder, shared_pca=False):
 
+        super().__init__()
+        pg.setConfigOption('background', 'w')
+
+        self.sorting_analyzer = sorting_analyzer
         self.have_extension = have_extension
-        self.data = DataForGUI(sorting_analyzer, have_extension, rec_samples)
         self.save_folder = save_folder
-        
-        self.decision_counter = 0
 
-        good_units = list(get_good_units(sorting_analyzer).index)
-        outlier_units = get_outlier_units(
-            self.data.spikes, self.data.rec_samples)
-        good_and_outlier_units = set(outlier_units).intersection(good_units)
-        self.outlier_ids = np.sort(np.array(list(good_and_outlier_units)))
-        #self.outlier_ids = outlier_units
-
-        print(f"{len(good_units)} good units.")
-        print(f"{len(self.outlier_ids)} outlier units.")
+        self.journal = DecisionJournal(save_folder)
 
         self.metrics = {}
+        self.template_vertices = {}
 
-        self.unit_id_1 = self.outlier_ids[0]
-        self.id_1_tracker = 0
-
-        possible_units = get_similar_units(
-            self.data.template_similarity, self.data.unit_ids, self.unit_id_1, self.data.merged_units)
-        self.possible_units = possible_units
-        self.unit_id_2 = self.possible_units[1]
-        self.id_2_tracker = 1
-
-        super().__init__()
+        self.unit_id_1 = None
+        self.unit_id_2 = None
+        self.fully_loaded = False
 
         self.setWindowTitle("QuickCurate")
 
@@ -173,20 +197,120 @@ class MainWindow(QtWidgets.QMainWindow):
 
         ############### Go go go! ###############
 
-        self.initialise_choice_df()
         self.setCentralWidget(widget)
 
-    def initialise_plot(self):
+        # the timing breakdown of the last key press, shown when timing is switched on with 't'
+        self.timing_hud = QtWidgets.QLabel(self)
+        self.timing_hud.setStyleSheet(
+            "background-color: rgba(255, 255, 255, 220); color: black; font-family: monospace; padding: 6px;")
+        self.timing_hud.setAttribute(QtCore.Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.timing_hud.hide()
+
+        # key presses only move the cursors. The pair they end up on is drawn once the queued
+        # key presses have been handled, so holding down a key doesn't draw every pair on the way
+        self.render_timer = QtCore.QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(0)
+        self.render_timer.timeout.connect(self.unit_ids_updated)
+
+        self.loading_progress = LoadingProgress()
+        # queued, so that tasks which finish before DataForGUI returns are handled once self.data is set
+        self.loading_progress.task_loaded.connect(self.task_loaded, QtCore.Qt.ConnectionType.QueuedConnection)
+        self.data = DataForGUI(sorting_analyzer, have_extension, rec_samples, shared_pca=shared_pca,
+                               wait=False, on_task_loaded=self.loading_progress.task_loaded.emit)
+        self.prefetcher = PairPrefetcher(self.data)
+
+        self.update_loading_text()
+        self.update_timing_hud()
+
+    def task_loaded(self, task_name):
+        """Draws whatever can be drawn now that another loading task has finished."""
+
+        if task_name == 'unit locations' and self.data.is_loaded('unit locations'):
+            self.initialise_locations_plot()
+
+        if self.unit_id_1 is None and self.data.is_loaded('spikes', 'neighbours'):
+            self.choose_first_pair()
+
+        if self.unit_id_1 is None:
+            self.update_loading_text()
+            return
+
+        if not self.fully_loaded and self.data.is_loaded(*self.data.loading_tasks):
+            self.fully_loaded = True
+            print("Everything loaded!")
+            self.replay_journal()
+            self.unit_ids_updated()
+        else:
+            self.update_plot(self.data.get_unit_data(
+                self.unit_id_1, self.unit_id_2), self.metrics)
+
+    def loading_text(self):
+
+        loaded = [task_name for task_name, future in self.data.loading.items() if future.done()]
+        failed = [task_name for task_name in loaded if not self.data.is_loaded(task_name)]
+
+        the_text = f"<p>Loading... {len(loaded)}/{len(self.data.loading_tasks)} done.</p>"
+        for task_name in failed:
+            the_text += f"<p style='color: rgb(200, 0, 0)'>Could not load {task_name}.</p>"
+        return the_text
+
+    def update_loading_text(self):
+
+        text = pg.TextItem(html=self.loading_text())
+        self.text_widget.clear()
+        self.text_widget.addItem(text)
+        text.setPos(0, 0)
+        self.text_widget.setXRange(0, 15)
+        self.text_widget.setYRange(-1, 0)
+
+    def wait_until_loaded(self):
+        """Runs the event loop until all the data is loaded. Useful when there's no `app.exec()`."""
+
+        while not self.data.is_loaded(*self.data.loading_tasks) or not self.fully_loaded:
+            if all(future.done() for future in self.data.loading.values()) and not self.data.is_loaded(*self.data.loading_tasks):
+                self.data.wait_for(*self.data.loading_tasks)
+            QtWidgets.QApplication.processEvents()
+            time.sleep(0.01)
+
+    def choose_first_pair(self):
+
+        good_units = list(get_good_units(self.sorting_analyzer).index)
+        outlier_units = get_outlier_units(
+            self.data.spikes, self.data.rec_samples, self.sorting_analyzer.sampling_frequency)
+        good_and_outlier_units = set(outlier_units).intersection(good_units)
+        self.outlier_ids = np.sort(np.array(list(good_and_outlier_units)))
+        #self.outlier_ids = outlier_units
+
+        print(f"{len(good_units)} good units.")
+        print(f"{len(self.outlier_ids)} outlier units.")
+
+        self.unit_id_1 = self.outlier_ids[0]
+        self.id_1_tracker = 0
+
+        possible_units = self.data.neighbours.get_similar_units(self.unit_id_1)
+        self.possible_units = possible_units
+        self.unit_id_2 = self.possible_units[1]
+        self.id_2_tracker = 1
+
+    def initialise_locations_plot(self):
 
         self.unit_locations_widget.setXRange(
             self.data.unit_xmin, self.data.unit_xmax)
         self.unit_locations_widget.setYRange(
             self.data.unit_ymin, self.data.unit_ymax)
 
+        self.unit_locations_plot_1.setData(
+            self.data.channel_locations[:, 0], self.data.channel_locations[:, 1])
+        self.unit_locations_plot_2.setData(
+            self.data.unit_locations[:, 0], self.data.unit_locations[:, 1])
+
+    def initialise_plot(self):
+
         self.unit_locations_plot_1 = self.unit_locations_widget.plot(
-            self.data.channel_locations, pen=None, symbol="s", symbolSize=6)
+            pen=None, symbol="s", symbolSize=6)
         self.unit_locations_plot_2 = self.unit_locations_widget.plot(
-            self.data.unit_locations, pen=None, symbol="o", symbolSize=6, symbolBrush=(50, 200, 200, 200))
+            pen=None, symbol="o", symbolSize=6, symbolBrush=(50, 200, 200, 200))
         self.unit_locations_plot_3 = self.unit_locations_widget.plot(
             symbol="x", symbolSize=20, symbolBrush=unit_1_color)
         self.unit_locations_plot_4 = self.unit_locations_widget.plot(
@@ -207,9 +331,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.amps_plot_2 = self.amps_2_widget.plot(
             pen=None, symbolPen=None, symbol="o", symbolBrush=unit_2_color, symbolSize=4)
         self.amps_1_widget.setLabels(
-            title=f"Amplitudes of unit {self.unit_id_1}", bottom="time (s)", left="Max amp per spike (mV)")
+            title="Amplitudes of unit 1", bottom="time (s)", left="Max amp per spike (mV)")
         self.amps_2_widget.setLabels(
-            title=f"Amplitudes of unit {self.unit_id_2}", bottom="time (s)", left="Max amp per spike (mV)")
+            title="Amplitudes of unit 2", bottom="time (s)", left="Max amp per spike (mV)")
         
         self.locs_raster_plot_1 = self.locations_widget.plot(
             pen=None, symbolPen=None, symbol="o", symbolBrush=unit_1_color, symbolSize=4)
@@ -248,10 +372,10 @@ class MainWindow(QtWidgets.QMainWindow):
             stepMode="left", fillLevel=0, fillOutline=True, brush=(0, 0, 255, 150))
         self.correlogram_22_plot = self.correlogram_22_widget.plot(
             stepMode="left", fillLevel=0, fillOutline=True, brush=unit_2_color)
-        self.correlogram_11_widget.setLabels(title=f"Auto correlogram for unit {self.unit_id_1}")
+        self.correlogram_11_widget.setLabels(title=f"Auto correlogram for unit 1")
         self.correlogram_12_widget.setLabels(title=f"Cross-correlogram")
         self.correlogram_21_widget.setLabels(title=f"Auto correlogram, if units were merged")
-        self.correlogram_22_widget.setLabels(title=f"Auto correlogram for unit {self.unit_id_2}")
+        self.correlogram_22_widget.setLabels(title=f"Auto correlogram for unit 2")
 
         self.binned_spikes_plot_2 = self.binned_spikes_widget.plot(
             stepMode="left", fillLevel=0, fillOutline=True, brush=unit_2_color)
@@ -266,19 +390,13 @@ class MainWindow(QtWidgets.QMainWindow):
             pen=pg.mkPen(unit_2_color, width=2))
         self.all_templates_widget.setLabels(title=f"All templates")
 
-
-        unit_data = self.data.get_unit_data(self.unit_id_1, self.unit_id_2)
-        self.metrics = compute_metrics(
-            self.data, self.unit_id_1, self.unit_id_2)
-
-        self.update_plot(unit_data, self.metrics)
-
     def strike_merged(self, unit_id):
         if unit_id in self.data.merged_units:
             return f"<s>{unit_id}</s>"
         else:
             return f"{unit_id}"
 
+    @timer.timed("update_plot")
     def update_plot(self, unit_data, metrics_data):
 
         if self.id_1_tracker == 0:
@@ -306,6 +424,9 @@ class MainWindow(QtWidgets.QMainWindow):
             </p>
             """
 
+        if not self.fully_loaded:
+            the_text += self.loading_text()
+
         for metric, data in metrics_data.items():
             the_text += f"{metric}: {data}.<br />"
 
@@ -316,81 +437,104 @@ class MainWindow(QtWidgets.QMainWindow):
         self.text_widget.setXRange(0, 15)
         self.text_widget.setYRange(-1, 0)
 
-        self.amps_plot_1.setData(unit_data['rand_spike_1'], unit_data['amp_1'])
-        self.amps_plot_2.setData(unit_data['rand_spike_2'], unit_data['amp_2'])
+        if 'amp_1' in unit_data:
+            self.amps_plot_1.setData(unit_data['rand_spike_1'], unit_data['amp_1'])
+            self.amps_plot_2.setData(unit_data['rand_spike_2'], unit_data['amp_2'])
 
-        if self.have_extension["spike_locations"]:
+        if self.have_extension["spike_locations"] and 'locs_x_1' in unit_data:
             self.locs_raster_plot_1.setData(
                 unit_data['locs_x_1'], unit_data['locs_y_1'])
             self.locs_raster_plot_2.setData(
                 unit_data['locs_x_2'], unit_data['locs_y_2'])
 
-        self.templates_1_plot.setData(unit_data['template_1'])
-        self.templates_2_plot.setData(unit_data['template_2'])
+        if 'template_1' in unit_data:
+            self.templates_1_plot.setData(unit_data['template_1'])
+            self.templates_2_plot.setData(unit_data['template_2'])
+
+        if 'pca_1' in unit_data:
+            self.update_pca_plots(unit_data['pca_1'], unit_data['pca_2'])
+
+        if 'binned_spikes_1' in unit_data:
+            self.binned_spikes_plot_2.setData(
+                unit_data['binned_spikes_1']+unit_data['binned_spikes_2'])
+            self.binned_spikes_plot_1.setData(
+                unit_data['binned_spikes_1'])
+
+        if 'correlogram_11' in unit_data:
+            self.correlogram_11_plot.setData(
+                np.arange(0, len(unit_data['correlogram_11']), 1), unit_data['correlogram_11'])
+            self.correlogram_12_plot.setData(
+                np.arange(0, len(unit_data['correlogram_12']), 1), unit_data['correlogram_12'])
+            self.correlogram_21_plot.setData(
+                np.arange(0, len(unit_data['correlogram_21']), 1), unit_data['correlogram_21'])
+            self.correlogram_22_plot.setData(
+                np.arange(0, len(unit_data['correlogram_22']), 1), unit_data['correlogram_22'])
+
+        if 'unit_location_1' in unit_data:
+            self.unit_locations_plot_3.setData([unit_data['unit_location_1'][0]], [
+                                               unit_data['unit_location_1'][1]])
+            self.unit_locations_plot_4.setData([unit_data['unit_location_2'][0]], [
+                                               unit_data['unit_location_2'][1]])
+
+        if 'all_template_1' in unit_data and 'channel_locations' in unit_data:
+            self.update_template_plot(
+                unit_data['channel_locations'], unit_data['all_template_1'], unit_data['all_template_2'])
+        
+        self.amps_1_widget.setLabels(
+            title=f"Amplitudes of unit {self.unit_id_1}", bottom="time (s)", left="Max amp per spike (mV)")
+        self.amps_2_widget.setLabels(
+            title=f"Amplitudes of unit {self.unit_id_2}", bottom="time (s)", left="Max amp per spike (mV)")
+        
+        self.correlogram_11_widget.setLabels(title=f"Auto correlogram for unit {self.unit_id_1}")
+        self.correlogram_22_widget.setLabels(title=f"Auto correlogram for unit {self.unit_id_2}")
+
+    def update_pca_plots(self, pca_1, pca_2):
 
         self.pca_11_plot_1.setData(
-            unit_data['pca_1'][:, 0], unit_data['pca_1'][:, 1])
+            pca_1[:, 0], pca_1[:, 1])
         self.pca_11_plot_2.setData(
-            unit_data['pca_2'][:, 0], unit_data['pca_2'][:, 1])
+            pca_2[:, 0], pca_2[:, 1])
         self.pca_12_plot_1.setData(
-            unit_data['pca_1'][:, 0], unit_data['pca_1'][:, 2])
+            pca_1[:, 0], pca_1[:, 2])
         self.pca_12_plot_2.setData(
-            unit_data['pca_2'][:, 0], unit_data['pca_2'][:, 2])
+            pca_2[:, 0], pca_2[:, 2])
         self.pca_21_plot_1.setData(
-            unit_data['pca_1'][:, 1], unit_data['pca_1'][:, 2])
+            pca_1[:, 1], pca_1[:, 2])
         self.pca_21_plot_2.setData(
-            unit_data['pca_2'][:, 1], unit_data['pca_2'][:, 2])
+            pca_2[:, 1], pca_2[:, 2])
         self.pca_22_plot_1.setData(
-            unit_data['pca_1'][:, 2], unit_data['pca_1'][:, 3])
+            pca_1[:, 2], pca_1[:, 3])
         self.pca_22_plot_2.setData(
-            unit_data['pca_2'][:, 2], unit_data['pca_2'][:, 3])
-
-        self.binned_spikes_plot_2.setData(
-            unit_data['binned_spikes_1']+unit_data['binned_spikes_2'])
-        self.binned_spikes_plot_1.setData(
-            unit_data['binned_spikes_1'])
-
-        self.correlogram_11_plot.setData(
-            np.arange(0, len(unit_data['correlogram_11']), 1), unit_data['correlogram_11'])
-        self.correlogram_12_plot.setData(
-            np.arange(0, len(unit_data['correlogram_12']), 1), unit_data['correlogram_12'])
-        self.correlogram_21_plot.setData(
-            np.arange(0, len(unit_data['correlogram_21']), 1), unit_data['correlogram_21'])
-        self.correlogram_22_plot.setData(
-            np.arange(0, len(unit_data['correlogram_22']), 1), unit_data['correlogram_22'])
-
-        self.unit_locations_plot_3.setData([unit_data['unit_location_1'][0]], [
-                                           unit_data['unit_location_1'][1]])
-        self.unit_locations_plot_4.setData([unit_data['unit_location_2'][0]], [
-                                           unit_data['unit_location_2'][1]])
-
-        self.all_templates_widget.clear()
-        self.update_template_plot(
-            unit_data['channel_locations'], unit_data['all_template_1'], unit_data['all_template_2'])
-        
-        self.amps_1_widget.setLabels(
-            title=f"Amplitudes of unit {self.unit_id_1}", bottom="time (s)", left="Max amp per spike (mV)")
-        self.amps_2_widget.setLabels(
-            title=f"Amplitudes of unit {self.unit_id_2}", bottom="time (s)", left="Max amp per spike (mV)")
-        
-        self.correlogram_11_widget.setLabels(title=f"Auto correlogram for unit {self.unit_id_1}")
-        self.correlogram_22_widget.setLabels(title=f"Auto correlogram for unit {self.unit_id_2}")
+            pca_2[:, 2], pca_2[:, 3])
 
-    def update_template_plot(self, channel_locations, all_template_1, all_template_2):
+    def get_template_vertices(self, unit_id, channel_locations, num_samples):
+        """The x positions, y offsets and connect mask to draw all of a unit's
+        templates as one curve. Only depends on the unit's channels, so is kept
+        until the unit is merged."""
 
-        template_channels_locs_1 = channel_locations[self.data.sparsity_mask[self.unit_id_1]]
-        template_channels_locs_2 = channel_locations[self.data.sparsity_mask[self.unit_id_2]]
+        if unit_id not in self.template_vertices:
+            template_channels_locs = channel_locations[self.data.sparsity_mask[unit_id]]
 
-        for template_index, template_channel_loc in enumerate(template_channels_locs_1):
-            curve = pg.PlotCurveItem(4*template_channel_loc[0] + np.arange(
-                90), template_channel_loc[1]/1 + all_template_1[template_index, :], pen=pg.mkPen(unit_2_color, width=2))
-            self.all_templates_widget.addItem(curve)
-            
+            x = 4*template_channels_locs[:, 0, np.newaxis] + np.arange(num_samples)
+            y_offset = np.repeat(template_channels_locs[:, 1], num_samples)
+            connect = np.ones(x.shape, dtype=bool)
+            connect[:, -1] = False
+
+            self.template_vertices[unit_id] = (x.ravel(), y_offset, connect.ravel())
+
+        return self.template_vertices[unit_id]
+
+    @timer.timed("update_template_plot")
+    def update_template_plot(self, channel_locations, all_template_1, all_template_2):
 
-        for template_index, template_channel_loc in enumerate(template_channels_locs_2):
-            curve = pg.PlotCurveItem(4*template_channel_loc[0] + np.arange(
-                90), template_channel_loc[1]/1 + all_template_2[template_index, :], pen=pg.mkPen(unit_1_color, width=2))
-            self.all_templates_widget.addItem(curve)
+        for unit_id, all_template, all_templates_plot in [
+                (self.unit_id_1, all_template_1, self.all_templates_1_plot),
+                (self.unit_id_2, all_template_2, self.all_templates_2_plot)]:
+
+            x, y_offset, connect = self.get_template_vertices(
+                unit_id, channel_locations, np.shape(all_template)[1])
+            all_templates_plot.setData(
+                x, y_offset + np.ravel(all_template), connect=connect)
 
         self.all_templates_widget.enableAutoRange()
         # UPDATE VIEW!!!
@@ -400,11 +544,58 @@ class MainWindow(QtWidgets.QMainWindow):
 
         keystroke = event.text()
 
-        if keystroke == "m":
-            self.data.merge_data(self.unit_id_1, self.unit_id_2)
-            self.id_2_tracker = 1
-            self.possible_units = get_similar_units(
-                self.data.template_similarity, self.data.unit_ids, self.unit_id_1, self.data.merged_units)
+        if keystroke == "t":
+            timer.enabled = not timer.enabled
+            print(f"Timing {'on' if timer.enabled else 'off'}.")
+            self.update_timing_hud()
+            return
+
+        if not self.fully_loaded:
+            return
+
+        timer.start_keystroke(keystroke)
+        with timer.span("keystroke"):
+            self.handle_keystroke(keystroke)
+        self.update_timing_hud()
+
+    def handle_keystroke(self, keystroke):
+
+        if keystroke in ["m", "u", "r"]:
+            # these change the data, so first draw the pair they act on
+            self.flush_render()
+
+        unit_id_1, unit_id_2 = self.unit_id_1, self.unit_id_2
+        if self.render_timer.isActive():
+            # the pair was skipped past before being drawn. Computing its metrics here would
+            # cost as much as drawing it, so they're only journalled if they're already known
+            metrics = self.data.pair_metrics.get(
+                (unit_id_1, unit_id_2), {metric: np.nan for metric in self.metrics})
+        else:
+            metrics = self.metrics
+
+        # merges which don't happen are journalled as "no_merge", so replaying the journal doesn't make them
+        journal_keystroke = keystroke
+        if keystroke == "m" and self.id_2_tracker >= len(self.possible_units):
+            print(f"No match candidate to merge into {self.unit_id_1}")
+            journal_keystroke = "no_merge"
+        elif keystroke == "m":
+            self.prefetcher.invalidate()
+            if self.data.merge_data(self.unit_id_1, self.unit_id_2):
+                self.template_vertices.pop(self.unit_id_1, None)
+                self.id_2_tracker = 1
+                self.possible_units = self.data.neighbours.get_similar_units(self.unit_id_1)
+            else:
+                journal_keystroke = "no_merge"
+        elif keystroke in ["u", "r"]:
+            self.prefetcher.invalidate()
+            if keystroke == "u":
+                changed_pair = self.data.undo_merge()
+            else:
+                changed_pair = self.data.redo_merge()
+            if changed_pair is None:
+                print("Nothing to undo!" if keystroke == "u" else "Nothing to redo!")
+            else:
+                self.go_to_pair(*changed_pair)
         elif keystroke == "k":
             self.id_1_tracker += 1
             self.id_2_tracker = 1
@@ -432,44 +623,128 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.id_1_tracker += direction
                 self.unit_id_1 = self.outlier_ids[self.id_1_tracker]
 
-            self.possible_units = get_similar_units(
-                self.data.template_similarity, self.data.unit_ids, self.unit_id_1, self.data.merged_units)
+            self.possible_units = self.data.neighbours.get_similar_units(self.unit_id_1)
 
         if self.id_2_tracker >= len(self.possible_units):
             print(f"No more match candidates for {self.unit_id_1}")
         else:
             self.unit_id_2 = self.possible_units[self.id_2_tracker]
-            self.save_choice(keystroke)
-            self.unit_ids_updated()
+            self.render_timer.start()
+
+        self.save_choice(journal_keystroke, unit_id_1, unit_id_2, metrics)
 
+    @timer.timed("unit_ids_updated")
     def unit_ids_updated(self):
 
-        unit_data = self.data.get_unit_data(self.unit_id_1, self.unit_id_2)
-        self.metrics = compute_metrics(
-            self.data, self.unit_id_1, self.unit_id_2)
+        upcoming_pairs = self.upcoming_pairs()
+        # don't let work for pairs which were skipped past hold up this one
+        self.prefetcher.drop_stale(upcoming_pairs)
+
+        with timer.span("fetch pair"):
+            unit_data, self.metrics = self.prefetcher.get(self.unit_id_1, self.unit_id_2)
 
         self.update_plot(unit_data, self.metrics)
+        self.prefetcher.prefetch(upcoming_pairs)
+        self.prefetcher.submit(self.data.precompute_pair_metrics,
+                               [(self.unit_id_1, unit_id_2) for unit_id_2 in self.possible_units[1:]])
+        self.update_timing_hud()
+
+    def flush_render(self):
+        """Draws the current pair now, if it's waiting to be drawn."""
+
+        if self.render_timer.isActive():
+            self.render_timer.stop()
+            self.unit_ids_updated()
+
+    def upcoming_pairs(self, num_ahead=3):
+        """The pairs the curator is likely to look at next: the current pair, the
+        next few candidates, the first pair of the next outlier and the previous pair."""
 
-    def initialise_choice_df(self):
-        string_to_write = "index,keystroke,unit_id_1,unit_id_2"
-        for key in self.metrics.keys():
-            string_to_write += f",{key}"
-        string_to_write += "\n"
+        pairs = [(self.unit_id_1, self.unit_id_2)]
 
-        with open(self.save_folder / "decision_data.csv", 'w') as decision_file:
-            decision_file.write(string_to_write)
+        for id_2_tracker in range(self.id_2_tracker + 1, self.id_2_tracker + num_ahead + 1):
+            if id_2_tracker < len(self.possible_units):
+                pairs.append((self.unit_id_1, self.possible_units[id_2_tracker]))
 
-    def save_choice(self, keystroke):
+        next_id_1_tracker = self.id_1_tracker + 1
+        while next_id_1_tracker < len(self.outlier_ids) and self.outlier_ids[next_id_1_tracker] in self.data.merged_units:
+            next_id_1_tracker += 1
+        if next_id_1_tracker < len(self.outlier_ids):
+            next_unit_id_1 = self.outlier_ids[next_id_1_tracker]
+            next_possible_units = self.data.neighbours.get_similar_units(next_unit_id_1)
+            if len(next_possible_units) > 1:
+                pairs.append((next_unit_id_1, next_possible_units[1]))
 
-        string_to_write = f"{self.decision_counter},{keystroke},{self.unit_id_1},{self.unit_id_2}"
-        for values in self.metrics.values():
-            string_to_write += f",{values}"
-        string_to_write += "\n"
+        if self.id_2_tracker > 1:
+            pairs.append((self.unit_id_1, self.possible_units[self.id_2_tracker - 1]))
 
-        with open(self.save_folder / "decision_data.csv", 'a') as decision_file:
-            decision_file.write(string_to_write)
+        return pairs
 
-        self.decision_counter += 1
+    def go_to_pair(self, unit_id_1, unit_id_2):
+        """Moves the cursors to a pair which has just been unmerged, or to unit 1's best
+        candidate if unit 2 has been merged away."""
+
+        self.template_vertices.pop(unit_id_1, None)
+        self.id_1_tracker = int(np.flatnonzero(self.outlier_ids == unit_id_1)[0])
+        self.unit_id_1 = self.outlier_ids[self.id_1_tracker]
+        self.possible_units = self.data.neighbours.get_similar_units(self.unit_id_1)
+        if unit_id_2 in self.possible_units[1:]:
+            self.id_2_tracker = self.possible_units.index(unit_id_2, 1)
+        else:
+            self.id_2_tracker = 1
+
+    def replay_journal(self):
+        """Redoes the merges from earlier sessions and puts the cursors back where they were."""
+
+        records = self.journal.records
+        if records is None or len(records) == 0:
+            return
+
+        print(f"Replaying {len(records)} decisions from {self.journal.records_path}")
+        for record in records:
+            if record['keystroke'] == b"m":
+                unit_id_1, unit_id_2 = int(record['unit_id_1']), int(record['unit_id_2'])
+                self.data.merge_data(unit_id_1, unit_id_2)
+            elif record['keystroke'] == b"u":
+                self.data.undo_merge()
+            elif record['keystroke'] == b"r":
+                self.data.redo_merge()
+        self.template_vertices = {}
+
+        self.id_1_tracker = min(max(int(records[-1]['id_1_tracker']), 0), len(self.outlier_ids) - 1)
+        while self.outlier_ids[self.id_1_tracker] in self.data.merged_units and self.id_1_tracker + 1 < len(self.outlier_ids):
+            self.id_1_tracker += 1
+        self.unit_id_1 = self.outlier_ids[self.id_1_tracker]
+        self.possible_units = self.data.neighbours.get_similar_units(self.unit_id_1)
+        self.id_2_tracker = min(max(int(records[-1]['id_2_tracker']), 1), len(self.possible_units) - 1)
+        self.unit_id_2 = self.possible_units[self.id_2_tracker]
+
+    def save_choice(self, keystroke, unit_id_1, unit_id_2, metrics):
+        """Journals a keystroke made while looking at the pair (`unit_id_1`, `unit_id_2`)."""
+
+        self.journal.append(keystroke, unit_id_1, unit_id_2,
+                            self.id_1_tracker, self.id_2_tracker, metrics)
+
+    def update_timing_hud(self):
+
+        if not timer.enabled:
+            self.timing_hud.hide()
+            return
+
+        self.timing_hud.setText(timer.summary_text())
+        self.timing_hud.adjustSize()
+        self.timing_hud.move(self.width() - self.timing_hud.width() - 10, 10)
+        self.timing_hud.show()
+        self.timing_hud.raise_()
+
+    def closeEvent(self, event):
+        self.prefetcher.shutdown()
+        self.data.executor.shutdown(wait=False, cancel_futures=True)
+        self.journal.close()
+        self.journal.export_csv(self.save_folder / "decision_data.csv")
+        if len(timer.spans) > 0:
+            timer.export_chrome_trace(self.save_folder / "timing_trace.json")
+        super().closeEvent(event)
 
 
 if __name__ == '__main__':
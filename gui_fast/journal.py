@@ -0,0 +1,160 @@
+"""
+    An append-only journal of the curator's decisions, kept in the merge_info folder.
+
+    Each keystroke is one fixed-size binary record: the pair being looked at, the
+    keystroke, where the cursors ended up and the pair's metrics as float64 columns.
+    Records are written by a background thread as they come in, and synced to disk
+    in batches. Relaunching the GUI replays the journal, so no decisions are lost.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+JOURNAL_VERSION = 1
+JOURNAL_NAME = "decision_journal"
+
+
+def get_record_dtype(metric_names):
+
+    return np.dtype([
+        ('index', '<i8'),
+        ('time', '<f8'),
+        ('keystroke', 'S8'),
+        ('unit_id_1', '<i8'),
+        ('unit_id_2', '<i8'),
+        ('id_1_tracker', '<i8'),
+        ('id_2_tracker', '<i8'),
+        ('metrics', '<f8', (len(metric_names),)),
+    ])
+
+
+def read_journal(folder):
+    """Returns the journal's records and metric names, or None if there is no journal.
+    A record which was only partly written, e.g. during a crash, is cut off the end of the file."""
+
+    header_path = Path(folder) / f"{JOURNAL_NAME}.json"
+    records_path = Path(folder) / f"{JOURNAL_NAME}.bin"
+    if not header_path.is_file() or not records_path.is_file():
+        return None
+
+    with open(header_path) as header_file:
+        header = json.load(header_file)
+    if header.get("version") != JOURNAL_VERSION:
+        return None
+    metric_names = header["metric_names"]
+    dtype = get_record_dtype(metric_names)
+
+    with open(records_path, 'rb+') as records_file:
+        raw = records_file.read()
+        num_records = len(raw) // dtype.itemsize
+        if num_records * dtype.itemsize != len(raw):
+            print(f"Dropping a partly written record from the end of {records_path}")
+            records_file.truncate(num_records * dtype.itemsize)
+
+    records = np.frombuffer(raw[:num_records * dtype.itemsize], dtype=dtype)
+    return records, metric_names
+
+
+class DecisionJournal:
+
+    def __init__(self, folder, sync_interval_s=1.0):
+
+        self.folder = Path(folder)
+        self.header_path = self.folder / f"{JOURNAL_NAME}.json"
+        self.records_path = self.folder / f"{JOURNAL_NAME}.bin"
+        self.sync_interval_s = sync_interval_s
+
+        journal = read_journal(folder)
+        if journal is None:
+            self.records, self.metric_names = None, None
+            if self.records_path.exists():
+                self.records_path.rename(self.records_path.with_suffix(".bin.old"))
+        else:
+            self.records, self.metric_names = journal
+
+        self.num_records = 0 if self.records is None else len(self.records)
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def append(self, keystroke, unit_id_1, unit_id_2, id_1_tracker, id_2_tracker, metrics):
+        """Queues a decision to be written. Returns straight away."""
+
+        if self.metric_names is None:
+            self.metric_names = list(metrics.keys())
+            with open(self.header_path, 'w') as header_file:
+                json.dump({"version": JOURNAL_VERSION, "metric_names": self.metric_names}, header_file)
+
+        record = np.zeros(1, dtype=get_record_dtype(self.metric_names))
+        record['index'] = self.num_records
+        record['time'] = time.time()
+        record['keystroke'] = keystroke.encode()
+        record['unit_id_1'] = unit_id_1
+        record['unit_id_2'] = unit_id_2
+        record['id_1_tracker'] = id_1_tracker
+        record['id_2_tracker'] = id_2_tracker
+        record['metrics'] = [metrics.get(metric_name, np.nan) for metric_name in self.metric_names]
+
+        self.num_records += 1
+        self.pending.put(record.tobytes())
+
+    def write_records(self):
+        """Runs on the writer thread. Writes records as soon as they arrive, so they survive
+        the GUI crashing, but only fsyncs every `sync_interval_s`."""
+
+        last_sync = time.monotonic()
+        unsynced = False
+        closing = False
+
+        with open(self.records_path, 'ab') as records_file:
+            while not closing:
+                timeout = self.sync_interval_s if unsynced else None
+                try:
+                    batch = [self.pending.get(timeout=timeout)]
+                except queue.Empty:
+                    batch = []
+                while not self.pending.empty():
+                    batch.append(self.pending.get())
+
+                if None in batch:
+                    closing = True
+                    batch = [record for record in batch if record is not None]
+
+                if len(batch) > 0:
+                    records_file.write(b"".join(batch))
+                    records_file.flush()
+                    unsynced = True
+
+                if unsynced and (closing or time.monotonic() - last_sync >= self.sync_interval_s):
+                    os.fsync(records_file.fileno())
+                    last_sync = time.monotonic()
+                    unsynced = False
+
+    def close(self):
+        """Writes and syncs everything still queued."""
+
+        self.pending.put(None)
+        self.writer.join()
+
+    def export_csv(self, csv_path):
+        """Writes the whole journal as a csv with one row per decision."""
+
+        journal = read_journal(self.folder)
+        if journal is None:
+            return
+        records, metric_names = journal
+
+        lines = [",".join(["index", "keystroke", "unit_id_1", "unit_id_2"] + metric_names)]
+        for record in records:
+            values = [str(record['index']), record['keystroke'].decode(),
+                      str(record['unit_id_1']), str(record['unit_id_2'])]
+            values += [str(value) for value in record['metrics']]
+            lines.append(",".join(values))
+
+        with open(csv_path, 'w') as csv_file:
+            csv_file.write("\n".join(lines) + "\n")
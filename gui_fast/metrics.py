@@ -1,5 +1,8 @@
 import numpy as np
 
+from compute import get_binned_counts
+from timing import timer
+
 qm_metrics_list = ['presence_ratio', 'snr',
                'isi_violations_ratio', 'rp_contamination',
                'sync_spike_2', 'sync_spike_4', 'firing_range',
@@ -10,69 +13,92 @@ tm_metrics_list = ['peak_to_valley', 'peak_trough_ratio', 'half_width',
                'spread']
 
 
+@timer.timed("compute_metrics")
 def compute_metrics(data, unit_id_1, unit_id_2):
 
-    single_metrics = get_single_unit_metrics(data, unit_id_1, unit_id_2)
-    relative_metrics = get_relative_metrics(data, unit_id_1, unit_id_2)
+    metric_columns = compute_metric_columns(data, [unit_id_1], [unit_id_2])
+
+    return {metric: values[0] for metric, values in metric_columns.items()}
+
+
+def compute_pair_metrics_table(data, pairs):
+    """Computes the metrics from `compute_metrics` for a list of (unit_id_1, unit_id_2) pairs
+    in one go. Returns a DataFrame with one row per pair, indexed by the pair."""
+
+    import pandas as pd
+
+    units_1 = [pair[0] for pair in pairs]
+    units_2 = [pair[1] for pair in pairs]
+    metric_columns = compute_metric_columns(data, units_1, units_2)
+
+    index = pd.MultiIndex.from_arrays([units_1, units_2], names=['unit_id_1', 'unit_id_2'])
+    return pd.DataFrame(metric_columns, index=index)
+
+
+def compute_metric_columns(data, units_1, units_2):
+
+    single_metrics = get_single_unit_metrics(data, units_1, units_2)
+    relative_metrics = get_relative_metrics(data, units_1, units_2)
 
     return single_metrics | relative_metrics
 
 
-def get_single_unit_metrics(data, unit_id_1, unit_id_2):
+def get_single_unit_metrics(data, units_1, units_2):
 
     single_unit_metrics = {}
 
-    quality_metrics = data.quality_metrics
-    template_metrics = data.template_metrics
+    # metrics missing from the analyzer (e.g. from a different spikeinterface version) are NaN
+    quality_metrics = data.quality_metrics.reindex(columns=qm_metrics_list)
+    template_metrics = data.template_metrics.reindex(columns=tm_metrics_list)
 
-    qm_list = qm_metrics_list
-    tm_list = tm_metrics_list
+    for a, unit_ids in enumerate([units_1, units_2]):
 
-    for a, unit_id in enumerate([unit_id_1, unit_id_2]):
+        unit_quality_metrics = quality_metrics.loc[unit_ids].to_numpy()
+        unit_template_metrics = template_metrics.loc[unit_ids].to_numpy()
 
-        for metric in qm_list:
-            single_unit_metrics[f'{metric}_{a}'] = quality_metrics[metric][unit_id]
+        for metric_index, metric in enumerate(qm_metrics_list):
+            single_unit_metrics[f'{metric}_{a}'] = unit_quality_metrics[:, metric_index]
 
-        for metric in tm_list:
-            single_unit_metrics[f'{metric}_{a}'] = template_metrics[metric][unit_id]
+        for metric_index, metric in enumerate(tm_metrics_list):
+            single_unit_metrics[f'{metric}_{a}'] = unit_template_metrics[:, metric_index]
 
     return single_unit_metrics
 
 
 def l2_metric(d1, d2):
-    return np.sqrt(np.pow(d1[0] - d2[0], 2) + np.pow(d1[1] - d2[1], 2))
+    return np.sqrt(np.pow(d1[..., 0] - d2[..., 0], 2) + np.pow(d1[..., 1] - d2[..., 1], 2))
 
 
-def get_relative_metrics(data, unit_id_1, unit_id_2):
+def get_relative_metrics(data, units_1, units_2, num_bins=6):
 
     relative_unit_metrics = {}
 
     unit_locations = data.unit_locations
 
-    unit_location_1 = unit_locations[unit_id_1]
-    unit_location_2 = unit_locations[unit_id_2]
-
     relative_unit_metrics['separation'] = l2_metric(
-        unit_location_1, unit_location_2)
+        unit_locations[units_1], unit_locations[units_2])
 
-    total_samples = np.sum(list(data.rec_samples.values()))
-    combined_spikes = np.sort(np.concatenate(
-        [data.spikes[unit_id_1], data.spikes[unit_id_2]]))
+    total_samples = data.get_total_samples()
 
-    relative_unit_metrics['combined_firing_range'] = compute_firing_range(
-        combined_spikes, total_samples)
+    firing_range_bins = 60
+    combined_spike_counts = get_binned_counts(data.spikes, units_1, firing_range_bins, total_samples) + \
+        get_binned_counts(data.spikes, units_2, firing_range_bins, total_samples)
+    combined_firing_ranges = get_firing_ranges(combined_spike_counts, total_samples)
 
-    relative_unit_metrics['combined_isi_violations'] = compute_contamination(
-        combined_spikes, total_samples)
+    combined_isi_violations = np.zeros(len(units_1))
+    for pair_index, (unit_id_1, unit_id_2) in enumerate(zip(units_1, units_2)):
+        combined_isi_violations[pair_index] = compute_merged_contamination(
+            data.spikes[unit_id_1], data.spikes[unit_id_2], total_samples)
 
-    relative_unit_metrics['template_similarity'] = data.template_similarity[unit_id_1, unit_id_2]
+    relative_unit_metrics['combined_firing_range'] = combined_firing_ranges
+    relative_unit_metrics['combined_isi_violations'] = combined_isi_violations
 
-    binned_spikes_1, _ = np.histogram(data.spikes[unit_id_1], bins=6)
-    binned_spikes_2, _ = np.histogram(data.spikes[unit_id_2], bins=6)
+    relative_unit_metrics['template_similarity'] = data.template_similarity[units_1, units_2]
 
-    for a, binned_spikes in enumerate([binned_spikes_1, binned_spikes_2]):
-        for b, bin in enumerate(binned_spikes):
-            relative_unit_metrics[f'spikes_{a}_bin_{b}'] = bin
+    for a, unit_ids in enumerate([units_1, units_2]):
+        all_binned_spikes = get_binned_counts(data.spikes, unit_ids, num_bins, total_samples)
+        for b in range(num_bins):
+            relative_unit_metrics[f'spikes_{a}_bin_{b}'] = all_binned_spikes[:, b]
 
     return relative_unit_metrics
 
@@ -91,14 +117,28 @@ def compute_firing_range(spikes, total_samples, percentiles=(5, 95), bins=60):
     return firing_range
 
 
+def get_firing_ranges(spike_counts, total_samples, percentiles=(5, 95)):
+    """Same as `compute_firing_range`, for rows of spike counts in equal bins spanning the recording."""
+
+    bin_size_s = (total_samples / 30_000)/spike_counts.shape[1]
+    firing_rates = spike_counts / bin_size_s
+
+    return np.percentile(firing_rates, percentiles[1], axis=1) - np.percentile(firing_rates, percentiles[0], axis=1)
+
+
 def compute_contamination(spikes, total_samples, isi_threshold_s=0.0015):
 
-    total_duration_s = total_samples/30_000
     isi_threshold_samples = round(isi_threshold_s*30_000)
 
     isis = np.diff(spikes)
     num_violations = np.sum(isis < isi_threshold_samples)
-    num_spikes = len(spikes)
+
+    return get_isi_violations_rate(num_violations, len(spikes), total_samples, isi_threshold_s)
+
+
+def get_isi_violations_rate(num_violations, num_spikes, total_samples, isi_threshold_s=0.0015):
+
+    total_duration_s = total_samples/30_000
 
     violation_time = 2 * num_spikes * isi_threshold_s
 
@@ -108,3 +148,41 @@ def compute_contamination(spikes, total_samples, isi_threshold_s=0.0015):
     isi_violations_rate = num_violations / total_duration_s
 
     return isi_violations_rate
+
+
+# Merge previews: statistics of the spike train two units would have if they were merged,
+# computed from the two sorted spike trains without making the merged train.
+
+def compute_merged_contamination(spikes_1, spikes_2, total_samples, isi_threshold_s=0.0015):
+    """Same as `compute_contamination` on the merged spike train."""
+
+    isi_threshold_samples = round(isi_threshold_s*30_000)
+    num_violations = count_merged_isi_violations(spikes_1, spikes_2, isi_threshold_samples)
+
+    return get_isi_violations_rate(num_violations, len(spikes_1) + len(spikes_2), total_samples, isi_threshold_s)
+
+
+def count_merged_isi_violations(spikes_1, spikes_2, isi_threshold_samples):
+    """Number of ISIs shorter than `isi_threshold_samples` in the merged spike train.
+
+    In the merged train, the spike after each spike is the closer of the next spike from its
+    own train and the next spike from the other train. When spikes from both trains are at
+    the same time, those from `spikes_1` are put first."""
+
+    num_violations = 0
+    for spikes, other_spikes, side in [(spikes_1, spikes_2, 'left'), (spikes_2, spikes_1, 'right')]:
+        if len(spikes) == 0:
+            continue
+
+        gap_to_next = np.full(len(spikes), np.inf)
+        gap_to_next[:-1] = np.diff(spikes)
+
+        next_other_index = np.searchsorted(other_spikes, spikes, side=side)
+        has_next_other = next_other_index < len(other_spikes)
+        gap_to_next[has_next_other] = np.minimum(
+            gap_to_next[has_next_other],
+            other_spikes[next_other_index[has_next_other]] - spikes[has_next_other])
+
+        num_violations += np.sum(gap_to_next < isi_threshold_samples)
+
+    return num_violations
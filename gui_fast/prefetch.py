@@ -0,0 +1,83 @@
+"""
+    Compute the data for the upcoming pairs of units in the background, so
+    that a key press only has to swap in data which is already there.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+def compute_pair_data(data, unit_id_1, unit_id_2):
+
+    unit_data = data.get_unit_data(unit_id_1, unit_id_2)
+    metrics = data.get_pair_metrics(unit_id_1, unit_id_2)
+
+    return unit_data, metrics
+
+
+class PairPrefetcher:
+
+    def __init__(self, data, num_workers=2):
+
+        self.data = data
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.futures = {}
+        self.submitted = []
+        # futures from `submit`
+        self.other_work = []
+
+    def prefetch(self, pairs):
+        """Starts computing `pairs`, in order, and cancels any work which isn't wanted anymore."""
+
+        self.drop_stale(pairs)
+
+        for pair in pairs:
+            if pair not in self.futures:
+                future = self.executor.submit(compute_pair_data, self.data, *pair)
+                self.futures[pair] = future
+                self.submitted.append(future)
+
+        self.submitted = [future for future in self.submitted if not future.done()]
+
+    def submit(self, function, *args):
+        """Runs any other background work which reads the data, so that `invalidate` also waits for it."""
+
+        future = self.executor.submit(function, *args)
+        self.submitted.append(future)
+        self.other_work.append(future)
+        return future
+
+    def drop_stale(self, pairs):
+        """Forgets the pairs which aren't in `pairs` and cancels their work, and any other work,
+        which hasn't started yet. Work which has started is left to finish."""
+
+        for pair in list(self.futures.keys()):
+            if pair not in pairs:
+                self.futures.pop(pair).cancel()
+
+        for future in self.other_work:
+            future.cancel()
+        self.other_work = []
+
+    def get(self, unit_id_1, unit_id_2):
+        """Returns the unit data and metrics for a pair, waiting for them if they're still being computed."""
+
+        future = self.futures.get((unit_id_1, unit_id_2))
+        if future is None or future.cancelled():
+            future = Future()
+            future.set_result(compute_pair_data(self.data, unit_id_1, unit_id_2))
+            self.futures[(unit_id_1, unit_id_2)] = future
+
+        return future.result()
+
+    def invalidate(self):
+        """Drops everything computed so far. Call this before the data changes, e.g. before a merge."""
+
+        for future in self.submitted:
+            future.cancel()
+        wait(self.submitted)
+
+        self.futures = {}
+        self.submitted = []
+        self.other_work = []
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -2,6 +2,8 @@
     Stuff related to comparing units and deciding which are similar
 """
 
+from bisect import bisect_right
+
 import numpy as np
 
 
@@ -14,3 +16,153 @@ def get_similar_units(template_similarity, unit_ids, unit_1, merged_units):
             if (other_unit_id := unit_ids[unit_index]) not in merged_units:
                 similar_units.append(other_unit_id)
     return similar_units
+
+
+class NeighbourIndex:
+    """The most similar units to each unit, ranked from most to least similar.
+
+    Built once from the template similarity and the unit locations: only units with a
+    similarity above `min_similarity` and within `max_distance_um` of each other on the
+    probe are kept, up to `max_neighbours` per unit. After a merge, `update_unit` patches
+    the lists which involve the merged unit, and `remove_unit` hides the unit which was
+    merged away, so nothing is re-ranked from scratch."""
+
+    def __init__(self, template_similarity, unit_ids, unit_locations, max_distance_um=150,
+                 min_similarity=0.2, max_neighbours=50):
+
+        self.unit_ids = np.asarray(unit_ids)
+        self.max_distance_um = max_distance_um
+        self.min_similarity = min_similarity
+        self.max_neighbours = max_neighbours
+        self.removed = set()
+
+        # for each unit, its neighbours' indices and their similarities, most similar first
+        self.neighbours = []
+        self.neighbour_similarities = []
+        # for each unit, the units which have it as a neighbour
+        self.neighbour_of = [set() for _ in self.unit_ids]
+
+        distances = np.linalg.norm(unit_locations[:, np.newaxis, :] - unit_locations[np.newaxis, :, :], axis=2)
+        is_candidate = (template_similarity > min_similarity) & (distances <= max_distance_um)
+
+        for unit_index in range(len(self.unit_ids)):
+            candidates = np.flatnonzero(is_candidate[unit_index])
+            similarities = template_similarity[unit_index, candidates]
+            order = np.argsort(-similarities, kind="stable")[:max_neighbours]
+
+            self.neighbours.append(list(candidates[order]))
+            self.neighbour_similarities.append(list(similarities[order]))
+            for neighbour_index in candidates[order]:
+                self.neighbour_of[neighbour_index].add(unit_index)
+
+    def get_similar_units(self, unit_id):
+        """The unit's neighbours which haven't been merged away, most similar first.
+        Usually includes `unit_id` itself, first."""
+
+        return [self.unit_ids[neighbour_index] for neighbour_index in self.neighbours[unit_id]
+                if neighbour_index not in self.removed]
+
+    def remove_unit(self, unit_id):
+
+        self.removed.add(unit_id)
+
+    def restore_unit(self, unit_id):
+
+        self.removed.discard(unit_id)
+
+    def update_unit(self, unit_id, template_similarity, unit_locations):
+        """Re-ranks the lists involving `unit_id`, after its similarities or location changed."""
+
+        distances = np.linalg.norm(unit_locations - unit_locations[unit_id], axis=1)
+        is_candidate = distances <= self.max_distance_um
+
+        # its own list
+        candidates = np.flatnonzero(is_candidate & (template_similarity[unit_id, :] > self.min_similarity))
+        similarities = template_similarity[unit_id, candidates]
+        order = np.argsort(-similarities, kind="stable")[:self.max_neighbours]
+
+        for neighbour_index in self.neighbours[unit_id]:
+            self.neighbour_of[neighbour_index].discard(unit_id)
+        self.neighbours[unit_id] = list(candidates[order])
+        self.neighbour_similarities[unit_id] = list(similarities[order])
+        for neighbour_index in candidates[order]:
+            self.neighbour_of[neighbour_index].add(unit_id)
+
+        # its place in the lists of the units near it, or which had it as a neighbour
+        candidates = np.flatnonzero(is_candidate & (template_similarity[:, unit_id] > self.min_similarity))
+        for other_index in set(candidates) | self.neighbour_of[unit_id]:
+            if other_index == unit_id:
+                continue
+            self.remove_neighbour(other_index, unit_id)
+            if is_candidate[other_index] and template_similarity[other_index, unit_id] > self.min_similarity:
+                self.insert_neighbour(other_index, unit_id, template_similarity[other_index, unit_id])
+
+    def remove_neighbour(self, unit_index, neighbour_index):
+
+        neighbours = self.neighbours[unit_index]
+        if neighbour_index in neighbours:
+            position = neighbours.index(neighbour_index)
+            del neighbours[position]
+            del self.neighbour_similarities[unit_index][position]
+            self.neighbour_of[neighbour_index].discard(unit_index)
+
+    def insert_neighbour(self, unit_index, neighbour_index, similarity):
+
+        neighbours = self.neighbours[unit_index]
+        similarities = self.neighbour_similarities[unit_index]
+
+        position = bisect_right([-other_similarity for other_similarity in similarities], -similarity)
+        if position >= self.max_neighbours:
+            return
+
+        neighbours.insert(position, neighbour_index)
+        similarities.insert(position, similarity)
+        self.neighbour_of[neighbour_index].add(unit_index)
+
+        if len(neighbours) > self.max_neighbours:
+            dropped_index = neighbours.pop()
+            similarities.pop()
+            self.neighbour_of[dropped_index].discard(unit_index)
+
+
+def compute_template_similarity(template, mask, all_templates, sparsity_mask, support="union"):
+    """Cosine similarity between one template and every unit's template, as spikeinterface's
+    `template_similarity` extension computes it (with no lags).
+
+    `template` and each of `all_templates` are (num_sparse_channels, num_samples): they only
+    hold the unit's sparse channels, given by `mask` and the rows of `sparsity_mask`, and are
+    zero elsewhere. Units which share no
+    channels with `mask` have zero similarity; the rest are done in one vectorized pass."""
+
+    num_units, num_channels = sparsity_mask.shape
+    similarity = np.zeros(num_units, dtype='float32')
+
+    dense_template = np.zeros((num_channels, template.shape[1]), dtype='float64')
+    dense_template[mask] = template
+
+    overlapping_units = np.flatnonzero(np.any(sparsity_mask & mask, axis=1))
+    if len(overlapping_units) == 0:
+        return similarity
+
+    # every overlapping unit's sparse channels, stacked
+    other_templates = np.concatenate(
+        [all_templates[unit_index] for unit_index in overlapping_units]).astype('float64')
+    channels = np.nonzero(sparsity_mask[overlapping_units])[1]
+    unit_starts = np.concatenate([[0], np.cumsum(np.sum(sparsity_mask[overlapping_units], axis=1))[:-1]])
+
+    template_on_channels = dense_template[channels]
+    dot_products = np.add.reduceat(np.sum(template_on_channels * other_templates, axis=1), unit_starts)
+
+    if support == "intersection":
+        in_mask = mask[channels]
+        norms_1 = np.add.reduceat(np.sum(template_on_channels**2, axis=1), unit_starts)
+        norms_2 = np.add.reduceat(np.sum(other_templates**2, axis=1) * in_mask, unit_starts)
+    else:
+        # "union" and "dense": both templates are zero off their own channels
+        norms_1 = np.full(len(overlapping_units), np.sum(dense_template**2))
+        norms_2 = np.add.reduceat(np.sum(other_templates**2, axis=1), unit_starts)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarity[overlapping_units] = dot_products / np.sqrt(norms_1 * norms_2)
+
+    return similarity
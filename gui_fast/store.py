@@ -0,0 +1,86 @@
+"""
+    Per-unit data (amplitudes, locations, spikes...) held in one flat array.
+
+    Values are grouped by unit, and each unit's data is a view into the
+    flat array using CSR-style offsets. The flat array can be memory-mapped
+    from the on-disk cache, so e.g. the spike trains of long recordings
+    don't need to sit in RAM. Units which have been changed, e.g. by a merge,
+    are held separately. Their values can be built lazily, the first time
+    they're asked for.
+"""
+import numpy as np
+
+
+def group_by_unit(unit_indices, num_units):
+    """Returns the order which groups spikes by unit (keeping time order within
+    each unit) and the offsets of each unit's group."""
+
+    unit_indices = np.asarray(unit_indices)
+    order = np.argsort(unit_indices, kind="stable")
+    counts = np.bincount(unit_indices, minlength=num_units)
+
+    offsets = np.zeros(num_units + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return order, offsets
+
+
+class UnitStore:
+
+    def __init__(self, values, offsets, unit_ids):
+
+        self.values = values
+        self.offsets = offsets
+        self.unit_ids = unit_ids
+        self.unit_id_to_index = {unit_id: unit_index for unit_index, unit_id in enumerate(unit_ids)}
+        self.replaced = {}
+        self.pending = {}
+
+    def __getitem__(self, unit_id):
+
+        build = self.pending.get(unit_id)
+        if build is not None:
+            build()
+
+        if unit_id in self.replaced:
+            return self.replaced[unit_id]
+
+        return self.get_original(unit_id)
+
+    def __setitem__(self, unit_id, values):
+        self.replaced[unit_id] = np.asarray(values)
+        self.pending.pop(unit_id, None)
+
+    def get_original(self, unit_id):
+        """The unit's values from the flat array, ignoring any changes."""
+
+        unit_index = self.unit_id_to_index[unit_id]
+        return self.values[self.offsets[unit_index]:self.offsets[unit_index + 1]]
+
+    def set_lazy(self, unit_id, build):
+        """Replaces the unit's values with ones made by `build()` the next time they're asked
+        for. `build` should set them, using `store[unit_id] = values`."""
+
+        self.replaced.pop(unit_id, None)
+        self.pending[unit_id] = build
+
+    def reset(self, unit_id):
+        """Undoes any changes to the unit's values."""
+
+        self.replaced.pop(unit_id, None)
+        self.pending.pop(unit_id, None)
+
+    def __contains__(self, unit_id):
+        return unit_id in self.unit_id_to_index
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def __iter__(self):
+        return iter(self.unit_ids)
+
+    def keys(self):
+        return list(self.unit_ids)
+
+    def items(self):
+        return [(unit_id, self[unit_id]) for unit_id in self.unit_ids]
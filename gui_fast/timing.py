@@ -0,0 +1,121 @@
+"""
+    Optional timing of the GUI's stages, to find out what a slow key press spends its time on.
+
+    Code marks a stage with `with timer.span("name"):`, or a whole function with
+    `@timer.timed("name")`. Timing is off unless the
+    QUICKCURATE_TIMING environment variable is 1, or it's switched on in the GUI,
+    and then a span only checks a flag. When it's on, every span is kept so they can
+    be exported as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev),
+    and the spans on the GUI thread since the last key press are that key press's
+    breakdown. Spans can be nested, and a span's time includes its children's.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+class SpanTimer:
+
+    def __init__(self, enabled=False, max_spans=1_000_000, num_recent=200):
+
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # (name, start, duration, thread id), in ns
+        self.spans = deque(maxlen=max_spans)
+        self.thread_names = {}
+        # durations of the latest spans on the GUI thread, for the rolling percentiles
+        self.recent = defaultdict(lambda: deque(maxlen=num_recent))
+        self.keystroke = None
+        self.breakdown = {}
+        self.origin = time.perf_counter_ns()
+
+    def span(self, name):
+
+        if not self.enabled:
+            return nullcontext()
+        return self.timed_span(name)
+
+    def timed(self, name):
+        """Decorates a function so that each call to it is a span."""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return timed_function
+
+        return decorator
+
+    @contextmanager
+    def timed_span(self, name):
+
+        on_main_thread = threading.current_thread() is threading.main_thread()
+        if on_main_thread:
+            # so the breakdown is in the order the spans start
+            self.breakdown.setdefault(name, 0)
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            thread = threading.current_thread()
+            with self.lock:
+                self.spans.append((name, start, duration, thread.ident))
+                self.thread_names[thread.ident] = thread.name
+                if on_main_thread:
+                    self.breakdown[name] = self.breakdown.get(name, 0) + duration
+                    self.recent[name].append(duration)
+
+    def start_keystroke(self, keystroke):
+        """Starts a new breakdown, for the key press which is about to be handled."""
+
+        self.keystroke = keystroke
+        self.breakdown = {}
+
+    def get_percentiles(self, name, percentiles=(50, 90, 99)):
+        """Percentiles, in ms, of the recent durations of a span on the GUI thread."""
+
+        with self.lock:
+            durations = np.array(self.recent[name])
+        if len(durations) == 0:
+            return [np.nan] * len(percentiles)
+        return list(np.percentile(durations, percentiles) / 1e6)
+
+    def summary_text(self, percentiles=(50, 90, 99)):
+        """The last key press's breakdown and the rolling percentiles of its stages, in ms."""
+
+        lines = [f"{'last key ' + repr(self.keystroke):<24}{'ms':>8}" +
+                 "".join(f"{f'p{percentile}':>8}" for percentile in percentiles)]
+        for name, duration in list(self.breakdown.items()):
+            lines.append(f"{name:<24}{duration / 1e6:8.1f}" +
+                         "".join(f"{value:8.1f}" for value in self.get_percentiles(name, percentiles)))
+
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, trace_path):
+        """Writes the spans in the Chrome trace event format."""
+
+        process_id = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+            thread_names = dict(self.thread_names)
+
+        events = [{"name": "thread_name", "ph": "M", "pid": process_id, "tid": thread_id,
+                   "args": {"name": thread_name}} for thread_id, thread_name in thread_names.items()]
+        events += [{"name": name, "ph": "X", "pid": process_id, "tid": thread_id,
+                    "ts": (start - self.origin) / 1000, "dur": duration / 1000}
+                   for name, start, duration, thread_id in spans]
+
+        with open(trace_path, 'w') as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+timer = SpanTimer(enabled=os.environ.get("QUICKCURATE_TIMING") == "1")
@@ -0,0 +1,72 @@
+"""
+    Reading units' waveforms from the waveforms extension, only on the channels asked for.
+
+    The extension stores each waveform on its unit's sparse channels. Rather than
+    densifying every waveform to all channels and then slicing, this reads just
+    the unit's rows and the requested channels, from a memory-mapped file when the
+    analyzer is saved as a binary folder.
+"""
+import numpy as np
+
+from store import group_by_unit
+from extension_data import load_extension_array
+
+
+class WaveformReader:
+
+    def __init__(self, sorting_analyzer):
+
+        self.waveforms = load_extension_array(sorting_analyzer, "waveforms", "waveforms")
+        self.unit_ids = sorting_analyzer.unit_ids
+        self.unit_id_to_index = {unit_id: unit_index for unit_index, unit_id in enumerate(self.unit_ids)}
+
+        # the rows of each unit's waveforms, in the order the extension stores them
+        random_spikes = sorting_analyzer.get_extension("random_spikes").get_random_spikes()
+        self.rows, self.row_offsets = group_by_unit(random_spikes["unit_index"], len(self.unit_ids))
+
+        sparsity = sorting_analyzer.sparsity
+        num_channels = sorting_analyzer.get_num_channels()
+        self.unit_id_to_channel_indices = {
+            unit_id: np.arange(num_channels) if sparsity is None else sparsity.unit_id_to_channel_indices[unit_id]
+            for unit_id in self.unit_ids}
+
+    def get_channel_indices(self, unit_id):
+        """The channels the unit's waveforms are stored on."""
+
+        return self.unit_id_to_channel_indices[unit_id]
+
+    def get_num_waveforms(self, unit_id):
+
+        unit_index = self.unit_id_to_index[unit_id]
+        return self.row_offsets[unit_index + 1] - self.row_offsets[unit_index]
+
+    def get_waveforms(self, unit_id, channel_indices, num_waveforms=None):
+        """The unit's first `num_waveforms` waveforms on `channel_indices`, of shape
+        (num_waveforms, num_samples, len(channel_indices)). Channels the unit isn't stored on are zero."""
+
+        unit_index = self.unit_id_to_index[unit_id]
+        rows = self.rows[self.row_offsets[unit_index]:self.row_offsets[unit_index + 1]][:num_waveforms]
+
+        channel_indices = np.asarray(channel_indices)
+        unit_channels = self.unit_id_to_channel_indices[unit_id]
+        positions = np.minimum(np.searchsorted(unit_channels, channel_indices), len(unit_channels) - 1)
+        is_stored = unit_channels[positions] == channel_indices
+
+        if isinstance(self.waveforms, np.ndarray):
+            stored_waveforms = self.waveforms[rows][:, :, positions[is_stored]]
+        else:
+            # e.g. zarr, which can read just these rows and channels
+            stored_waveforms = self.waveforms.oindex[rows, :, positions[is_stored]]
+
+        if np.all(is_stored):
+            return stored_waveforms
+
+        waveforms = np.zeros(stored_waveforms.shape[:2] + (len(channel_indices),), dtype=stored_waveforms.dtype)
+        waveforms[:, :, is_stored] = stored_waveforms
+        return waveforms
+
+    def get_flat_waveforms(self, unit_id, channel_indices, num_waveforms=None):
+        """Same as `get_waveforms`, with each waveform flattened to one row, sample by sample."""
+
+        waveforms = self.get_waveforms(unit_id, channel_indices, num_waveforms)
+        return waveforms.reshape(len(waveforms), -1)
@@ -2,89 +2,297 @@
     Wrangling the data needed to construct the GUI
 """
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from copy import deepcopy
+from pathlib import Path
 
-import spikeinterface.full as si
-from spikeinterface.widgets import unit_locations
 from curate import get_outlier_units, get_good_units
-from compute import get_concat_waveforms, get_pcs_from_waveforms, get_binned_spikes
+from compute import get_concat_waveforms, get_pcs_from_waveforms, get_binned_spikes, get_common_channels, \
+    get_shared_projections, get_pcs_from_projections, get_channel_positions, get_correlogram_bins, get_correlogram
+from cache import PairCache
+from waveforms import WaveformReader
+from extension_data import load_extension_array, gather
+from similarity import NeighbourIndex, compute_template_similarity
+from store import UnitStore, group_by_unit
+from groups import MergeGroups
+from metrics import compute_metrics, compute_pair_metrics_table
+from disk_cache import CACHE_FOLDER_NAME, get_cache_folder, load_arrays, save_arrays, remove_stale_caches
+from timing import timer
+
+
+max_spikes_per_unit = 3000
+pca_radius_um = 50
+max_undo = 100
+correlogram_window_ms = 50.0
+correlogram_bin_ms = 1.0
+
+
+def compute_random_spike_arrays(sorting_analyzer, have_extension):
+    """A random subsample of each unit's spikes, with their amplitudes and locations."""
+
+    import spikeinterface.full as si
+
+    arrays = {}
+    num_units = len(sorting_analyzer.unit_ids)
+
+    random_spike_indices = si.random_spikes_selection(
+        sorting_analyzer.sorting, max_spikes_per_unit=max_spikes_per_unit)
+    spike_vector = sorting_analyzer.sorting.to_spike_vector()
+    random_spikes = spike_vector[random_spike_indices]
+    random_order, arrays['random_offsets'] = group_by_unit(
+        random_spikes['unit_index'], num_units)
+    random_spike_indices = random_spike_indices[random_order]
+    arrays['random_spikes'] = random_spikes['sample_index'][random_order]
+
+    # only the subsample is read from the per-spike extension arrays
+    if have_extension['spike_amplitudes']:
+        amps = load_extension_array(sorting_analyzer, "spike_amplitudes", "amplitudes")
+        arrays['amps'] = gather(amps, random_spike_indices)
+
+    if have_extension['spike_locations']:
+        locs = gather(load_extension_array(sorting_analyzer, "spike_locations", "spike_locations"),
+                      random_spike_indices)
+        arrays['locs_x'] = locs['x']
+        arrays['locs_y'] = locs['y']
+
+    return arrays
+
+
+def compute_spike_arrays(sorting_analyzer, have_extension):
+    """Every spike, grouped by unit."""
+
+    arrays = {}
+    num_units = len(sorting_analyzer.unit_ids)
+
+    spikes = sorting_analyzer.sorting.to_spike_vector(concatenated=False)[0]
+    spike_order, arrays['spike_offsets'] = group_by_unit(spikes['unit_index'], num_units)
+    arrays['spike_samples'] = spikes['sample_index'][spike_order]
+
+    return arrays
+
+
+def compute_pca_sparsity_arrays(sorting_analyzer, have_extension):
+    """The channels close to each unit, which are used for the PCA plots."""
+
+    import spikeinterface.full as si
+
+    arrays = {}
+
+    sparsity_for_pca = si.compute_sparsity(sorting_analyzer, radius_um=pca_radius_um)
+    channel_indices = [sparsity_for_pca.unit_id_to_channel_indices[unit_id]
+                       for unit_id in sorting_analyzer.unit_ids]
+    arrays['pca_channel_offsets'] = np.cumsum(
+        [0] + [len(indices) for indices in channel_indices])
+    arrays['pca_channel_indices'] = np.concatenate(channel_indices).astype(np.int64)
+
+    return arrays
+
+
+def compute_template_arrays(sorting_analyzer, have_extension):
+    """The templates, and the channel each one is biggest on."""
+
+    import spikeinterface.full as si
+
+    arrays = {}
+
+    arrays['max_channels'] = sorting_analyzer.channel_ids_to_indices(
+        si.get_template_extremum_channel(sorting_analyzer).values()
+    )
+    arrays['templates'] = sorting_analyzer.get_extension("templates").get_data()
+
+    return arrays
 
 
 class DataForGUI:
+    """All the data the GUI needs, taken from the sorting analyzer.
 
-    def __init__(self, sorting_analyzer, have_extension, rec_samples):
+    The data is loaded as a set of independent tasks, run in parallel on a thread pool.
+    If `wait` is False, this returns straight away and `on_task_loaded(task_name)` is
+    called as each task finishes, once `is_loaded` counts it as finished (usually from a
+    worker thread). Use `is_loaded` and `wait_for` to check on them."""
+
+    def __init__(self, sorting_analyzer, have_extension, rec_samples, shared_pca=False,
+                 wait=True, on_task_loaded=None, num_workers=4):
 
         self.merged_units = []
+        self.groups = MergeGroups(sorting_analyzer.unit_ids)
+        # (unit_id_1, unit_id_2, state of unit_id_1 before or after the merge)
+        self.undo_stack = deque(maxlen=max_undo)
+        self.redo_stack = deque(maxlen=max_undo)
         self.sorting_analyzer = sorting_analyzer
+        self.have_extension = have_extension
+        self.shared_pca = shared_pca
 
         self.unit_ids = deepcopy(sorting_analyzer.unit_ids)
 
         self.rec_samples = rec_samples
         ###############   Get data from sorting analyzer ###############
 
-        print("caching amplitudes and locations...")
-
-        random_spike_indices = si.random_spikes_selection(sorting_analyzer.sorting, max_spikes_per_unit=3000)
-        spike_vector = sorting_analyzer.sorting.to_spike_vector()
-        random_spikes = spike_vector[random_spike_indices]
-        self.random_spikes = si.spike_vector_to_spike_trains([random_spikes], unit_ids = sorting_analyzer.unit_ids)[0]
-
-        self.amps = {}
-        if have_extension['spike_amplitudes']:
-            amps = sorting_analyzer.get_extension("spike_amplitudes").get_data()
-            random_amps = amps[random_spike_indices]
-
-            for unit_id in sorting_analyzer.unit_ids:
-                self.amps[unit_id] = []
-            
-            for spike, amp in zip(random_spikes, random_amps):
-                unit_id = spike['unit_index']
-                self.amps[unit_id].append(amp)
-        amps = None
-
-
-        self.locs_x = {}
-        self.locs_y = {}
-        if have_extension['spike_locations']:
-            locs_y = sorting_analyzer.get_extension("spike_locations").get_data()['y']
-            locs_x = sorting_analyzer.get_extension("spike_locations").get_data()['x']
-            random_locs_x = locs_x[random_spike_indices]
-            random_locs_y = locs_y[random_spike_indices]
-            
-            for unit_id in sorting_analyzer.unit_ids:
-                self.locs_x[unit_id] = []
-                self.locs_y[unit_id] = []
-
-            for spike, loc_x, loc_y in zip(random_spikes, random_locs_x, random_locs_y):
-                unit_id = spike['unit_index']
-                self.locs_x[unit_id].append(loc_x)
-                self.locs_y[unit_id].append(loc_y)
-        #locs = None
-
-        print("caching spikes...")
-        self.spikes = si.spike_vector_to_spike_trains(
-            sorting_analyzer.sorting.to_spike_vector(concatenated=False), unit_ids=sorting_analyzer.unit_ids)[0]
-        self.template_similarity = sorting_analyzer.get_extension(
-            "template_similarity").get_data()
-
-        self.sparsity_mask = sorting_analyzer.sparsity.mask
-        self.channel_locations = sorting_analyzer.get_channel_locations()
-        self.unit_locations = sorting_analyzer.get_extension(
+        self.cache_folder = None
+        if sorting_analyzer.folder is not None:
+            cache_params = {'max_spikes_per_unit': max_spikes_per_unit,
+                            'pca_radius_um': pca_radius_um, 'have_extension': have_extension}
+            self.cache_folder = get_cache_folder(
+                Path(sorting_analyzer.folder) / CACHE_FOLDER_NAME, sorting_analyzer.folder, cache_params)
+
+        self.pca_cache = PairCache()
+        self.correlogram_cache = PairCache(max_items=4096)
+        self.pair_metrics = {}
+
+        self.loading_tasks = {
+            'amplitudes and locations': self.load_random_spikes,
+            'spikes': self.load_spikes,
+            'template similarity': self.load_template_similarity,
+            'unit locations': self.load_locations,
+            'neighbours': self.load_neighbours,
+            'sparsity': self.load_sparsity,
+            'templates': self.load_templates,
+            'metrics': self.load_metrics,
+            'correlograms': self.load_correlograms,
+        }
+        with timer.span("DataForGUI.__init__"):
+            self.executor = ThreadPoolExecutor(max_workers=num_workers)
+            # filled in order, so a task can wait for the tasks listed before it
+            self.loading = {}
+            for task_name, load_function in self.loading_tasks.items():
+                self.loading[task_name] = self.executor.submit(self.run_loading_task, task_name, load_function)
+                if on_task_loaded is not None:
+                    # only once the future is done, so `is_loaded` already counts the task as finished
+                    self.loading[task_name].add_done_callback(
+                        lambda future, task_name=task_name: on_task_loaded(task_name))
+
+            if wait:
+                self.wait_for(*self.loading_tasks)
+
+    def run_loading_task(self, task_name, load_function):
+
+        print(f"caching {task_name}...")
+        try:
+            with timer.span(f"load {task_name}"):
+                load_function()
+        except Exception as error:
+            print(f"    - Could not load {task_name}: {error!r}")
+            raise
+
+    def is_loaded(self, *task_names):
+
+        for task_name in task_names:
+            future = self.loading[task_name]
+            if not future.done() or future.exception() is not None:
+                return False
+        return True
+
+    def wait_for(self, *task_names):
+        """Waits for the loading tasks to finish, raising any errors they hit."""
+
+        for task_name in task_names:
+            self.loading[task_name].result()
+
+    def load_cached_arrays(self, group_name, compute_function):
+        """Loads a group of arrays derived from the analyzer from the on-disk cache, making the cache first if needed."""
+
+        if self.cache_folder is None:
+            return compute_function(self.sorting_analyzer, self.have_extension)
+
+        group_folder = self.cache_folder / group_name
+        cached = load_arrays(group_folder)
+        if cached is not None:
+            print(f"    - Loaded {group_name} from cache {self.cache_folder}")
+            return cached
+
+        cached = compute_function(self.sorting_analyzer, self.have_extension)
+        try:
+            save_arrays(group_folder, cached)
+            remove_stale_caches(self.cache_folder)
+        except OSError as error:
+            print(f"    - Could not write cache to {group_folder}: {error}")
+            return cached
+
+        # read back memory-mapped, so the computed arrays don't stay in memory on the first launch either
+        return load_arrays(group_folder)
+
+    def load_random_spikes(self):
+
+        cached = self.load_cached_arrays('random_spikes', compute_random_spike_arrays)
+        random_offsets = cached['random_offsets']
+        unit_ids = self.sorting_analyzer.unit_ids
+
+        amps = {}
+        if self.have_extension['spike_amplitudes']:
+            amps = UnitStore(cached['amps'], random_offsets, unit_ids)
+
+        locs_x = {}
+        locs_y = {}
+        if self.have_extension['spike_locations']:
+            locs_x = UnitStore(cached['locs_x'], random_offsets, unit_ids)
+            locs_y = UnitStore(cached['locs_y'], random_offsets, unit_ids)
+
+        self.random_spikes = UnitStore(cached['random_spikes'], random_offsets, unit_ids)
+        self.amps = amps
+        self.locs_x = locs_x
+        self.locs_y = locs_y
+
+    def load_spikes(self):
+
+        cached = self.load_cached_arrays('spikes', compute_spike_arrays)
+        self.spikes = UnitStore(
+            cached['spike_samples'], cached['spike_offsets'], self.sorting_analyzer.unit_ids)
+
+    def load_template_similarity(self):
+
+        template_similarity_extension = self.sorting_analyzer.get_extension("template_similarity")
+        self.template_similarity = template_similarity_extension.get_data()
+
+        # merged units' similarities can be recomputed exactly for cosine similarity without lags
+        similarity_params = template_similarity_extension.params
+        self.similarity_support = similarity_params.get('support', 'union')
+        self.exact_similarity = similarity_params.get('method') in ['cosine', 'cosine_similarity'] and \
+            similarity_params.get('max_lag_ms', 0) == 0
+
+    def load_locations(self):
+
+        self.channel_locations = self.sorting_analyzer.get_channel_locations()
+        self.unit_locations = self.sorting_analyzer.get_extension(
             "unit_locations").get_data()[:, 0:2]
         self.unit_xmin = min(self.channel_locations[:, 0])
         self.unit_xmax = max(self.channel_locations[:, 0])
         self.unit_ymin = min(self.channel_locations[:, 1])
         self.unit_ymax = max(self.channel_locations[:, 1])
 
-        sparsity_for_pca = si.compute_sparsity(sorting_analyzer, radius_um=50)
+    def load_neighbours(self):
+
+        self.wait_for('template similarity', 'unit locations')
+        self.neighbours = NeighbourIndex(
+            self.template_similarity, self.unit_ids, self.unit_locations)
+
+    def load_sparsity(self):
 
-        self.unit_id_to_channel_indices = sparsity_for_pca.unit_id_to_channel_indices
-        self.waveforms = sorting_analyzer.get_extension("waveforms")
+        cached = self.load_cached_arrays('pca_sparsity', compute_pca_sparsity_arrays)
+        pca_channel_offsets = cached['pca_channel_offsets']
+        unit_id_to_channel_indices = {unit_id:
+                                      cached['pca_channel_indices'][pca_channel_offsets[unit_index]:pca_channel_offsets[unit_index + 1]]
+                                      for unit_index, unit_id in enumerate(self.sorting_analyzer.unit_ids)}
+        self.waveforms = WaveformReader(self.sorting_analyzer)
 
-        max_channels = sorting_analyzer.channel_ids_to_indices(
-            si.get_template_extremum_channel(sorting_analyzer).values()
-        )
-        templates_data = sorting_analyzer.get_extension("templates").get_data()
+        shared_projections = None
+        if self.shared_pca:
+            print("computing shared waveform projections...")
+            shared_projections = get_shared_projections(
+                self.sorting_analyzer, self.waveforms, unit_id_to_channel_indices)
+
+        self.unit_id_to_channel_indices = unit_id_to_channel_indices
+        self.shared_projections = shared_projections
+
+    def load_templates(self):
+
+        sorting_analyzer = self.sorting_analyzer
+        cached = self.load_cached_arrays('templates', compute_template_arrays)
+
+        self.sparsity_mask = sorting_analyzer.sparsity.mask
+
+        max_channels = cached['max_channels']
+        templates_data = cached['templates']
         self.templates = {unit_id_1:
                           templates_data[unit_id_1, :, max_channels[sorting_analyzer.sorting.id_to_index(
                               unit_id_1)]]
@@ -94,66 +302,145 @@ class DataForGUI:
                                   unit_id_1)]]
                               for unit_id_1 in sorting_analyzer.unit_ids}
 
-        self.quality_metrics = sorting_analyzer.get_extension(
+    def load_metrics(self):
+
+        self.quality_metrics = self.sorting_analyzer.get_extension(
             "quality_metrics").get_data().astype('float')
-        self.template_metrics = sorting_analyzer.get_extension(
+        self.template_metrics = self.sorting_analyzer.get_extension(
             "template_metrics").get_data().astype('float')
 
-        all_correlograms = sorting_analyzer.get_extension(
-            "correlograms").get_data()[0]
-        self.correlograms = all_correlograms
+    def load_correlograms(self):
+        """Correlograms are computed from the spike trains when they're needed, so this only sets the bins."""
+
+        self.correlogram_window_size, self.correlogram_bin_size = get_correlogram_bins(
+            self.sorting_analyzer.sampling_frequency, correlogram_window_ms, correlogram_bin_ms)
+
+    def get_total_samples(self):
+
+        return np.sum(list(self.rec_samples.values()))
 
+    def get_correlogram(self, unit_id_1, unit_id_2):
+
+        correlogram = self.correlogram_cache.get((unit_id_1, unit_id_2))
+        if correlogram is None:
+            with timer.span("correlogram"):
+                correlogram = get_correlogram(self.spikes[unit_id_1], self.spikes[unit_id_2],
+                                              self.correlogram_window_size, self.correlogram_bin_size,
+                                              same_unit=unit_id_1 == unit_id_2)
+            self.correlogram_cache.put((unit_id_1, unit_id_2), correlogram)
+
+        return correlogram
+
+    @timer.timed("get_unit_data")
     def get_unit_data(self, unit_index_1, unit_index_2):
+        """The data needed to plot a pair of units. Only has the data from loading tasks which have finished."""
 
         unit_data = {}
 
-        unit_data['amp_1'] = self.amps[unit_index_1]
-        unit_data['amp_2'] = self.amps[unit_index_2]
+        if self.is_loaded('amplitudes and locations'):
+            unit_data['amp_1'] = self.amps[unit_index_1]
+            unit_data['amp_2'] = self.amps[unit_index_2]
 
-        unit_data['locs_x_1'] = self.locs_x[unit_index_1]
-        unit_data['locs_x_2'] = self.locs_x[unit_index_2]
-        unit_data['locs_y_1'] = self.locs_y[unit_index_1]
-        unit_data['locs_y_2'] = self.locs_y[unit_index_2]
+            unit_data['locs_x_1'] = self.locs_x[unit_index_1]
+            unit_data['locs_x_2'] = self.locs_x[unit_index_2]
+            unit_data['locs_y_1'] = self.locs_y[unit_index_1]
+            unit_data['locs_y_2'] = self.locs_y[unit_index_2]
 
-        unit_data['spike_1'] = self.spikes[unit_index_1]
-        unit_data['spike_2'] = self.spikes[unit_index_2]
+            unit_data['rand_spike_1'] = self.random_spikes[unit_index_1]
+            unit_data['rand_spike_2'] = self.random_spikes[unit_index_2]
 
-        unit_data['rand_spike_1'] = self.random_spikes[unit_index_1]
-        unit_data['rand_spike_2'] = self.random_spikes[unit_index_2]
+        if self.is_loaded('spikes'):
+            unit_data['spike_1'] = self.spikes[unit_index_1]
+            unit_data['spike_2'] = self.spikes[unit_index_2]
 
-        unit_data['template_1'] = self.templates[unit_index_1]
-        unit_data['template_2'] = self.templates[unit_index_2]
+            unit_data['binned_spikes_1'], unit_data['binned_spikes_2'] = get_binned_spikes(
+                self.spikes, unit_index_1, unit_index_2, self.get_total_samples())
 
-        unit_data['correlogram_11'] = self.correlograms[unit_index_1][unit_index_1]
-        unit_data['correlogram_12'] = self.correlograms[unit_index_1][unit_index_2]
-        unit_data['correlogram_22'] = self.correlograms[unit_index_2][unit_index_2]
-        unit_data['correlogram_21'] = unit_data['correlogram_11'] + unit_data['correlogram_12'] + \
-            unit_data['correlogram_22'] + \
-            self.correlograms[unit_index_2][unit_index_1]
+        if self.is_loaded('templates'):
+            unit_data['template_1'] = self.templates[unit_index_1]
+            unit_data['template_2'] = self.templates[unit_index_2]
 
-        waveforms = get_concat_waveforms(
-            self.waveforms, unit_index_1, unit_index_2, self.unit_id_to_channel_indices)
-        if waveforms is None:
-            unit_data['pca_1'] = np.array([[0, 0, 0, 0]])
-            unit_data['pca_2'] = np.array([[0, 0, 0, 0]])
-        else:
-            unit_data['pca_1'], unit_data['pca_2'] = get_pcs_from_waveforms(
-                waveforms[0], waveforms[1])
+            unit_data['all_template_1'] = self.all_templates[unit_index_1]
+            unit_data['all_template_2'] = self.all_templates[unit_index_2]
 
-        unit_data['binned_spikes_1'], unit_data['binned_spikes_2'] = get_binned_spikes(
-            unit_data['spike_1'], unit_data['spike_2'])
+        if self.is_loaded('correlograms', 'spikes'):
+            unit_data['correlogram_11'] = self.get_correlogram(unit_index_1, unit_index_1)
+            unit_data['correlogram_12'] = self.get_correlogram(unit_index_1, unit_index_2)
+            unit_data['correlogram_22'] = self.get_correlogram(unit_index_2, unit_index_2)
+            unit_data['correlogram_21'] = unit_data['correlogram_11'] + unit_data['correlogram_12'] + \
+                unit_data['correlogram_22'] + \
+                self.get_correlogram(unit_index_2, unit_index_1)
 
-        unit_data['unit_location_1'] = self.unit_locations[unit_index_1]
-        unit_data['unit_location_2'] = self.unit_locations[unit_index_2]
+        if self.is_loaded('sparsity'):
+            unit_data['pca_1'], unit_data['pca_2'] = self.get_pcs(unit_index_1, unit_index_2)
 
-        unit_data['all_template_1'] = self.all_templates[unit_index_1]
-        unit_data['all_template_2'] = self.all_templates[unit_index_2]
+        if self.is_loaded('unit locations'):
+            unit_data['unit_location_1'] = self.unit_locations[unit_index_1]
+            unit_data['unit_location_2'] = self.unit_locations[unit_index_2]
 
-        unit_data['channel_locations'] = self.channel_locations
+            unit_data['channel_locations'] = self.channel_locations
 
         return unit_data
 
+    def precompute_pair_metrics(self, pairs):
+        """Computes the metrics for many pairs in one go, so they can be looked up later."""
+
+        pairs = [pair for pair in pairs if pair not in self.pair_metrics]
+        if len(pairs) == 0:
+            return
+
+        pair_metrics_table = compute_pair_metrics_table(self, pairs)
+        for pair, metrics in zip(pairs, pair_metrics_table.to_dict('records')):
+            self.pair_metrics[pair] = metrics
+
+    def get_pair_metrics(self, unit_id_1, unit_id_2):
+
+        metrics = self.pair_metrics.get((unit_id_1, unit_id_2))
+        if metrics is None:
+            metrics = compute_metrics(self, unit_id_1, unit_id_2)
+            self.pair_metrics[(unit_id_1, unit_id_2)] = metrics
+
+        return metrics
+
+    def get_pcs(self, unit_id_1, unit_id_2):
+        """Principal components of the pair's waveforms on their common channels, cached per pair."""
+
+        if self.shared_projections is not None:
+            projections_1, channels_1 = self.shared_projections[unit_id_1]
+            projections_2, channels_2 = self.shared_projections[unit_id_2]
+            common_ids = np.intersect1d(channels_1, channels_2)
+        else:
+            common_ids = get_common_channels(
+                self.unit_id_to_channel_indices, unit_id_1, unit_id_2)
+        key = (unit_id_1, unit_id_2, tuple(common_ids))
+
+        pcs = self.pca_cache.get(key)
+        if pcs is None:
+            if self.shared_projections is not None:
+                pcs = get_pcs_from_projections(
+                    projections_1, channels_1, projections_2, channels_2)
+            else:
+                with timer.span("read waveforms"):
+                    waveforms = get_concat_waveforms(
+                        self.waveforms, unit_id_1, unit_id_2, self.unit_id_to_channel_indices)
+                with timer.span("pca"):
+                    pcs = None if waveforms is None else get_pcs_from_waveforms(
+                        waveforms[0], waveforms[1])
+            if pcs is None:
+                pcs = (np.array([[0, 0, 0, 0]]), np.array([[0, 0, 0, 0]]))
+            self.pca_cache.put(key, pcs)
+
+        return pcs
+
     def merge_data(self, unit_id_1, unit_id_2):
+        """Merges `unit_id_2` into `unit_id_1`. Returns False, having changed nothing, if either
+        unit has already been merged away."""
+
+        if unit_id_1 == unit_id_2 or not self.groups.is_root(unit_id_1) or not self.groups.is_root(unit_id_2):
+            print(f"Can't merge {unit_id_2} into {unit_id_1}: one of them has already been merged.")
+            return False
+
+        unit_state = self.get_unit_state(unit_id_1)
 
         unit_index_1 = unit_id_1
         unit_index_2 = unit_id_2
@@ -168,25 +455,6 @@ class DataForGUI:
         new_template_metrics = (
             self.template_metrics.iloc[unit_id_1].values + self.template_metrics.iloc[unit_id_2].values)/2
         
-        new_spikes = np.sort(np.concatenate(
-            [self.spikes[unit_id_1], self.spikes[unit_id_2]]))
-
-        new_random_spikes = np.sort(np.concatenate(
-            [self.random_spikes[unit_id_1], self.random_spikes[unit_id_2]]))
-        new_locs_x = np.concatenate(
-            [self.locs_x[unit_id_1], self.locs_x[unit_id_2]])
-        new_locs_y = np.concatenate(
-            [self.locs_y[unit_id_1], self.locs_y[unit_id_2]])
-        new_amps = np.concatenate([self.amps[unit_id_1], self.amps[unit_id_2]])
-
-        new_rand_spike_indices = np.random.choice(range(0,len(new_random_spikes)), size=min(3000,len(new_random_spikes)), replace=False)
-
-        new_random_spikes=new_random_spikes[new_rand_spike_indices]
-        new_locs_x=new_locs_x[new_rand_spike_indices]
-        new_locs_y=new_locs_y[new_rand_spike_indices]
-        new_amps=new_amps[new_rand_spike_indices]
-       
-
         combined_sparsity_mask = self.sparsity_mask[unit_id_1] * \
             self.sparsity_mask[unit_id_2]
 
@@ -200,24 +468,160 @@ class DataForGUI:
 
         self.sparsity_mask[unit_index_1] = combined_sparsity_mask
         self.unit_locations[unit_index_1] = new_unit_location
-        self.spikes[unit_id_1] = new_spikes
-        self.random_spikes[unit_id_1] = new_random_spikes
-        self.amps[unit_id_1] = new_amps
-        self.locs_x[unit_id_1] = new_locs_x
-        self.locs_y[unit_id_1] = new_locs_y
         self.all_templates[unit_index_1] = new_all_templates
         self.templates[unit_index_1] = new_max_templates
         self.template_metrics.iloc[unit_index_1] = new_template_metrics
         self.quality_metrics.iloc[unit_index_1] = new_quality_metrics
 
-        self.correlograms[unit_index_1, :] = self.correlograms[unit_index_1,
-                                                               :] + self.correlograms[unit_index_2, :]
-        self.correlograms[:, unit_index_1] = self.correlograms[:,
-                                                               unit_index_1] + self.correlograms[:, unit_index_2]
+        if self.exact_similarity:
+            new_similarity = compute_template_similarity(
+                new_all_templates, combined_sparsity_mask, self.all_templates, self.sparsity_mask,
+                support=self.similarity_support)
+            self.template_similarity[unit_index_1, :] = new_similarity
+            self.template_similarity[:, unit_index_1] = new_similarity
+        else:
+            self.template_similarity[unit_index_1, :] = (self.template_similarity[unit_index_1,
+                                                                                  :] + self.template_similarity[unit_index_2, :])/2
+            self.template_similarity[:, unit_index_1] = (self.template_similarity[:,
+                                                                                  unit_index_1] + self.template_similarity[:, unit_index_2])/2
+
+        if self.shared_projections is not None:
+            projections_1, channels_1 = self.shared_projections[unit_id_1]
+            projections_2, channels_2 = self.shared_projections[unit_id_2]
+            common_ids = np.intersect1d(channels_1, channels_2)
+            self.shared_projections[unit_id_1] = (np.concatenate([
+                projections_1[:, :, get_channel_positions(channels_1, common_ids)],
+                projections_2[:, :, get_channel_positions(channels_2, common_ids)]]), common_ids)
 
-        self.template_similarity[unit_index_1, :] = (self.template_similarity[unit_index_1,
-                                                                              :] + self.template_similarity[unit_index_2, :])/2
-        self.template_similarity[:, unit_index_1] = (self.template_similarity[:,
-                                                                              unit_index_1] + self.template_similarity[:, unit_index_2])/2
+        self.groups.merge(unit_id_1, unit_id_2)
+        self.group_changed(unit_id_1)
 
+        self.units_changed(unit_id_1, unit_id_2)
+        self.neighbours.remove_unit(unit_id_2)
+
+        self.merged_units.append(unit_id_2)
+        self.undo_stack.append((unit_id_1, unit_id_2, unit_state))
+        self.redo_stack.clear()
+
+        return True
+
+    def undo_merge(self):
+        """Reverses the last merge. Returns the pair which was unmerged, or None if there's nothing to undo."""
+
+        if len(self.undo_stack) == 0:
+            return None
+
+        unit_id_1, unit_id_2, unit_state = self.undo_stack.pop()
+        self.redo_stack.append((unit_id_1, unit_id_2, self.get_unit_state(unit_id_1)))
+        self.set_unit_state(unit_id_1, unit_state)
+        self.groups.split(unit_id_1, unit_id_2)
+        self.group_changed(unit_id_1)
+
+        self.units_changed(unit_id_1, unit_id_2)
+        self.neighbours.restore_unit(unit_id_2)
+        self.merged_units.remove(unit_id_2)
+
+        return unit_id_1, unit_id_2
+
+    def redo_merge(self):
+        """Merges the last unmerged pair again. Returns the pair, or None if there's nothing to redo."""
+
+        if len(self.redo_stack) == 0:
+            return None
+
+        unit_id_1, unit_id_2, unit_state = self.redo_stack.pop()
+        self.undo_stack.append((unit_id_1, unit_id_2, self.get_unit_state(unit_id_1)))
+        self.set_unit_state(unit_id_1, unit_state)
+        self.groups.merge(unit_id_1, unit_id_2)
+        self.group_changed(unit_id_1)
+
+        self.units_changed(unit_id_1, unit_id_2)
+        self.neighbours.remove_unit(unit_id_2)
         self.merged_units.append(unit_id_2)
+
+        return unit_id_1, unit_id_2
+
+    def units_changed(self, unit_id_1, unit_id_2):
+        """Drops anything computed from the two units and re-ranks unit 1's neighbours."""
+
+        self.pca_cache.evict_units({unit_id_1, unit_id_2})
+        self.correlogram_cache.evict_units({unit_id_1, unit_id_2})
+        self.pair_metrics = {pair: metrics for pair, metrics in self.pair_metrics.items()
+                             if unit_id_1 not in pair and unit_id_2 not in pair}
+
+        self.neighbours.update_unit(unit_id_1, self.template_similarity, self.unit_locations)
+
+    def group_changed(self, unit_id):
+        """Drops the spikes and random spikes of the group `unit_id` is the root of. If it's
+        a merged group, they're rebuilt from its members the next time they're asked for."""
+
+        random_spike_stores = [store for store in [self.random_spikes, self.amps, self.locs_x, self.locs_y]
+                               if isinstance(store, UnitStore)]
+
+        if len(self.groups.members(unit_id)) == 1:
+            self.spikes.reset(unit_id)
+            for store in random_spike_stores:
+                store.reset(unit_id)
+        else:
+            self.spikes.set_lazy(unit_id, lambda: self.build_group_spikes(unit_id))
+            for store in random_spike_stores:
+                store.set_lazy(unit_id, lambda: self.build_group_random_spikes(unit_id))
+
+    def build_group_spikes(self, unit_id):
+
+        members = self.groups.members(unit_id)
+        # each member's spikes are already sorted, which the stable sort (timsort) makes use of
+        self.spikes[unit_id] = np.sort(
+            np.concatenate([self.spikes.get_original(member) for member in members]), kind='stable')
+
+    def build_group_random_spikes(self, unit_id):
+        """A random subsample, in time order, of the group members' random spikes, along with
+        their amplitudes and locations. Seeded by the members, so it's the same each time."""
+
+        members = self.groups.members(unit_id)
+        random_spikes = np.concatenate([self.random_spikes.get_original(member) for member in members])
+        order = np.argsort(random_spikes, kind='stable')
+
+        rng = np.random.default_rng([int(member) for member in members])
+        num_kept = min(max_spikes_per_unit, len(order))
+        order = order[np.sort(rng.choice(len(order), size=num_kept, replace=False))]
+
+        for store in [self.amps, self.locs_x, self.locs_y, self.random_spikes]:
+            if isinstance(store, UnitStore):
+                store[unit_id] = np.concatenate([store.get_original(member) for member in members])[order]
+
+    def get_unit_state(self, unit_id):
+        """Everything `merge_data` changes for `unit_id`. Arrays which `merge_data` replaces are
+        kept by reference; only the rows and columns it writes into are copied."""
+
+        unit_index = unit_id
+
+        unit_state = {
+            'all_templates': self.all_templates[unit_index],
+            'templates': self.templates[unit_index],
+            'sparsity_mask': self.sparsity_mask[unit_index].copy(),
+            'unit_location': self.unit_locations[unit_index].copy(),
+            'template_metrics': self.template_metrics.iloc[unit_index].values.copy(),
+            'quality_metrics': self.quality_metrics.iloc[unit_index].values.copy(),
+            'similarity_row': self.template_similarity[unit_index, :].copy(),
+            'similarity_column': self.template_similarity[:, unit_index].copy(),
+        }
+        if self.shared_projections is not None:
+            unit_state['shared_projections'] = self.shared_projections[unit_id]
+
+        return unit_state
+
+    def set_unit_state(self, unit_id, unit_state):
+
+        unit_index = unit_id
+
+        self.all_templates[unit_index] = unit_state['all_templates']
+        self.templates[unit_index] = unit_state['templates']
+        self.sparsity_mask[unit_index] = unit_state['sparsity_mask']
+        self.unit_locations[unit_index] = unit_state['unit_location']
+        self.template_metrics.iloc[unit_index] = unit_state['template_metrics']
+        self.quality_metrics.iloc[unit_index] = unit_state['quality_metrics']
+        self.template_similarity[unit_index, :] = unit_state['similarity_row']
+        self.template_similarity[:, unit_index] = unit_state['similarity_column']
+        if self.shared_projections is not None:
+            self.shared_projections[unit_id] = unit_state['shared_projections']